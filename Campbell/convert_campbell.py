@@ -7,17 +7,240 @@ This Skript can be used to import data downloaded from Campbell Scientific data
 It cleanes unneccessary columns and converts the data into a long format with columns "time", "dataset_id", and "value"
 as required for ODMF record import. The mapping of datalogger channel names to dataset IDs is done using an Excel file. 
 The resulting DataFrame can be saved as a CSV file or directly imported into ODMF using the API.
+Any table of a Campbell Scientific logger in TOA5 format can be converted: only the channels mapped to a dataset are read.
 """
 
+import csv
+import fnmatch
+import glob
+import io
+import json
+import logging
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import yaml
 from odmfclient import login
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "export_ODMF"))
+from run_report import RunReport, stage, frame_bytes
 
-def convert_campbell_LED_to_ODMF_record(data_path, datasetmap, datalogger, starttime, endtime):
+
+TOA5_HEADER_ROWS = 4 # file information, column names, units and processing
+LED_CHANNELS = [f"SEVolt_Avg({i})" for i in range(1, 13)]
+
+
+# compact dtypes of the records written to Parquet and uploaded (float32 keeps about 7 significant digits, more than the loggers measure)
+RECORD_SCHEMA = pa.schema([("time", pa.timestamp("ns")), ("dataset_id", pa.int32()), ("value", pa.float32())])
+
+
+TOA5_FILE_FIELDS = ["file_format", "station", "logger_model", "serial_number", "os_version", "program", "program_signature", "table"]
+
+
+def read_toa5_header(data_path) -> dict:
+    '''
+    Reads the four header rows of a TOA5 file and returns a dictionary with the file information of the first row 
+    (file_format, station, logger_model, serial_number, os_version, program, program_signature and table), 
+    the columns with their units and processing (lists in the order of the columns) and the byte offset of the first data row (data_offset).
+    '''
+    with open(data_path, "rb") as f:
+        header_rows = [next(csv.reader([f.readline().decode("utf-8")]), []) for _ in range(TOA5_HEADER_ROWS)]
+        data_offset = f.tell()
+    header = dict(zip(TOA5_FILE_FIELDS, header_rows[0]))
+    if header.get("file_format") != "TOA5":
+        raise ValueError(f"{data_path} is not a TOA5 file (first header field: {header.get('file_format')})")
+    header.update(columns=header_rows[1], units=header_rows[2], processing=header_rows[3], data_offset=data_offset)
+    return header
+
+
+def parse_toa5_times(timestamps) -> pd.Series:
+    '''
+    Parses the TIMESTAMP column of a TOA5 table (yyyy-mm-dd hh:mm:ss with optional fractions of seconds). The fixed ISO format 
+    is converted by numpy directly, other values fall back to pandas.
+    '''
+    try:
+        return pd.Series(timestamps.to_numpy(dtype=object).astype("datetime64[ns]"), index=timestamps.index)
+    except ValueError:
+        return pd.to_datetime(timestamps, format="ISO8601")
+
+
+def toa5_read_options(header, channels) -> dict:
+    '''Returns the arguments of pd.read_csv for the data rows of a TOA5 file (see read_toa5_header) reading only TIMESTAMP and the given channels.'''
+    return dict(sep=',', header=None, names=header["columns"], usecols=["TIMESTAMP", *channels],
+                dtype={channel: "float64" for channel in channels}, na_values="NAN")
+
+
+def toa5_rows_to_frame(rows, channels) -> pd.DataFrame:
+    '''Replaces the TIMESTAMP column of parsed TOA5 rows by the parsed time stamps in the column "time", followed by the channels.'''
+    times = parse_toa5_times(rows.pop("TIMESTAMP"))
+    if list(rows.columns) != list(channels):
+        rows = rows[list(channels)] # channels given in another order than in the file
+    rows.insert(0, "time", times)
+    return rows
+
+
+def row_time(line) -> pd.Timestamp:
+    '''Returns the time stamp in the first field of a TOA5 data row (bytes), or NaT if it cannot be read.'''
+    return pd.to_datetime(line.split(b",", 1)[0].strip().strip(b'"').decode("utf-8"), errors="coerce")
+
+
+def row_before(data_path, offset, max_row_bytes=64*1024) -> bytes:
+    '''
+    Returns the last row of the file that ends at or (followed by blank lines) before the given byte offset 
+    (empty if the offset is not at the end of a row).
+    '''
+    with open(data_path, "rb") as f:
+        f.seek(max(0, offset - max_row_bytes))
+        before = f.read(offset - f.tell())
+    if not before.endswith(b"\n"):
+        return b""
+    before = before.rstrip() # blank lines, e.g. a line end written after the last row
+    return before[before.rfind(b"\n") + 1:]
+
+
+def find_first_row(f, start, lo, hi, min_span=64*1024) -> int:
+    '''
+    Binary search in a file with rows sorted by time: returns the byte offset of a row start at or before the first row 
+    with a time stamp >= start, skipping all but at most min_span bytes before it. lo has to be the offset of the first data row
+    and hi the size of the file.
+    '''
+    while hi - lo > min_span:
+        f.seek((lo + hi) // 2)
+        f.readline() # the rest of the row the middle falls into
+        position = f.tell()
+        if position >= hi:
+            break
+        line = f.readline()
+        first_time = row_time(line)
+        if pd.notna(first_time) and first_time < start:
+            lo = f.tell() # the row before start is skipped with everything in front of it
+        else:
+            hi = position
+    return lo
+
+
+def iter_campbell_blocks(data_path, starttime, endtime, chunksize=100000, sorted_times=True, channels=None):
+    '''
+    Reads a Campbell Scientific TOA5 file in blocks of rows and yields the rows between starttime and endtime (included) 
+    of each block as pd.DataFrame with the given channels (as float) and the parsed time stamps in the column "time" (instead of TIMESTAMP).
+    Only the TIMESTAMP column and the given channels are parsed.
+    Only the blocks that overlap the time span are parsed: with sorted_times, the start of the time span is found by a 
+    binary search in the file and reading stops at the first row after endtime, so the memory needed does not depend on the file size.
+
+    Parameters:
+    - data_path: Path to the data as downloaded from Campbell Scientific data logger (e.g., "CR300Series_Minutentabelle.dat").
+    - starttime: The start time for filtering the data.
+    - endtime: The end time for filtering the data.
+    - chunksize: Number of rows parsed at once.
+    - sorted_times: Set to False for files whose time stamps are not in ascending order (e.g. after the logger clock was reset), to read the whole file.
+    - channels: Names of the columns to read. The default is None (all columns except TIMESTAMP and RECORD).
+    '''
+    start = pd.to_datetime(starttime)
+    end = pd.to_datetime(endtime)
+    header = read_toa5_header(data_path)
+    if channels is None:
+        channels = [column for column in header["columns"] if column not in ("TIMESTAMP", "RECORD")]
+    missing = [channel for channel in channels if channel not in header["columns"]]
+    if missing:
+        raise ValueError(f"Channels {missing} are not in the table {header.get('table')} of {data_path}")
+
+    with open(data_path, "rb") as f:
+        offset = find_first_row(f, start, header["data_offset"], os.path.getsize(data_path)) if sorted_times else header["data_offset"]
+        f.seek(offset)
+        reader = pd.read_csv(f, chunksize=chunksize, **toa5_read_options(header, channels))
+        while True:
+            with stage("read_logger_file") as record:
+                position = f.tell()
+                block = next(reader, None)
+                if block is None:
+                    break
+                record.update(bytes_in=f.tell() - position, rows_out=len(block))
+                block = toa5_rows_to_frame(block, channels)
+                after_end = sorted_times and block["time"].iloc[-1] > end
+                block = block[(block["time"] >= start) & (block["time"] <= end)].reset_index(drop=True)
+                record["bytes_out"] = frame_bytes(block)
+            yield block
+            if after_end:
+                break
+
+
+def read_datasetmaps(datasetmap) -> dict:
+    '''Reads the Excel mapping once and returns the dataset IDs of the channels of each datalogger (datalogger as key, {channel name: dataset ID} as value).'''
+    map = pd.read_excel(datasetmap)
+    return {datalogger: dict(zip(logger_map["Channel_Name"], logger_map["dataset_id"])) for datalogger, logger_map in map.groupby("Datalogger", sort=False)}
+
+
+def read_datasetmap(datasetmap, datalogger) -> dict:
+    '''Returns the dataset IDs of the channels of the given datalogger from the Excel mapping (channel name as key).'''
+    return read_datasetmaps(datasetmap).get(datalogger, {})
+
+
+def file_datalogger(data_path, header, dataloggers=None) -> str:
+    '''
+    Returns the name of the datalogger of a logger file as used in the datasetmap: the value of the first entry of dataloggers whose key 
+    is the path of the file or matches its file name (pattern with * and ?, e.g. "CR300Series_*.dat"), else the station name in the TOA5 header.
+    '''
+    file_name = os.path.basename(data_path)
+    for key, datalogger in (dataloggers or {}).items():
+        if os.path.abspath(key) == os.path.abspath(data_path) or fnmatch.fnmatch(file_name, key):
+            return datalogger
+    return header["station"]
+
+
+def mapped_channels(data_path, map_dict) -> list:
+    '''Returns the channels of the TOA5 file that are mapped to a dataset, in the order of the file. Mapped channels missing in the file are logged.'''
+    columns = read_toa5_header(data_path)["columns"]
+    missing = [channel for channel in map_dict if channel not in columns]
+    if missing:
+        logging.warning(f"Channels {missing} of the datasetmap are not in {data_path} and are skipped")
+    return [column for column in columns if column in map_dict]
+
+
+def block_to_long(data, map_dict) -> pd.DataFrame:
+    '''
+    Converts logger data (wide, with the column "time" and one column per channel) to the long format with the columns "time", "dataset_id" and "value",
+    in the order of melt (all rows of the first channel, then the second, ...). Readings that are NaN are dropped.
+    The long columns are built directly from the arrays of the block (time stamps repeated for each channel, dataset IDs repeated for each row), 
+    without channel names per row.
+    '''
+    channels = [column for column in data.columns if column != "time"]
+
+    with stage("reshape", rows_in=len(data)) as record:
+        values = np.concatenate([data[channel].to_numpy(dtype="float64") for channel in channels]) if channels else np.empty(0)
+        times = np.tile(data["time"].to_numpy(), len(channels))
+        dataset_ids = np.repeat(np.array([map_dict[channel] for channel in channels], dtype="int64"), len(data))
+        measured = ~np.isnan(values)
+        if not measured.all():
+            values, times, dataset_ids = values[measured], times[measured], dataset_ids[measured]
+        data_long = pd.DataFrame({"time": times, "dataset_id": dataset_ids, "value": values}, copy=False)
+        record.update(rows_out=len(data_long), bytes_out=frame_bytes(data_long))
+
+    return data_long
+
+
+def iter_campbell_records(data_path, datasetmap, datalogger, starttime, endtime, channels=None, chunksize=100000, sorted_times=True):
+    '''
+    Streaming version of convert_campbell_to_ODMF_record: yields the records of each block of the file (see iter_campbell_blocks)
+    in the long format, so that files of any size can be converted (e.g. written to a csv file block by block) with flat memory use.
+    '''
+    map_dict = read_datasetmap(datasetmap, datalogger)
+    if channels is None:
+        channels = mapped_channels(data_path, map_dict)
+    for block in iter_campbell_blocks(data_path, starttime, endtime, chunksize, sorted_times, channels):
+        if not block.empty:
+            yield block_to_long(block, map_dict)
+
+
+def convert_campbell_to_ODMF_record(data_path, datasetmap, datalogger, starttime, endtime, channels=None, chunksize=100000, sorted_times=True):
     '''
-    Convert Campbell Scientific LED voltage data to a long format suitable for ODMF.
+    Convert data of any table of a Campbell Scientific data logger (TOA5 file) to a long format suitable for ODMF.
+    Only the channels mapped to a dataset and the rows between starttime and endtime are parsed (see iter_campbell_blocks).
 
     Parameters:
     - data_path: Path to the data as downloaded from Campbell Scientific data logger (e.g., "CR300Series_Minutentabelle.dat").
@@ -25,32 +248,344 @@ def convert_campbell_LED_to_ODMF_record(data_path, datasetmap, datalogger, start
     - datalogger: The name of the datalogger as in the datasetmap (e.g., "T2").
     - starttime: The start time for filtering the data (e.g. after ssetup of sensors is finished).
     - endtime: The end time for filtering the data (e.g. before next sensor adjustment).
+    - channels: Channels to convert, all of them need to be mapped in the datasetmap. The default is None (all channels of the datalogger in the datasetmap).
+    - chunksize, sorted_times: See iter_campbell_blocks.
     
     Returns:    
     - A pandas DataFrame with colums "time", "dataset_id", and "value" as required for ODMF record import. 
     '''
+    return convert_campbell_file(data_path, read_datasetmap(datasetmap, datalogger), starttime, endtime, channels, chunksize, sorted_times)[0]
 
-    data = pd.read_csv(data_path, sep=',', header=0, skiprows=[0, 2, 3], na_values="NAN")
-    LEDvolt_cols = [f"SEVolt_Avg({i})" for i in range(1, 13)]
-    LEDvolt_data = data[["TIMESTAMP", *LEDvolt_cols]]
 
-    LEDvolt_data["time"] = pd.to_datetime(LEDvolt_data["TIMESTAMP"], format="%Y-%m-%d %H:%M:%S")
-    LEDvolt_data = LEDvolt_data.drop(columns=["TIMESTAMP"])
+def convert_campbell_file(data_path, map_dict, starttime, endtime, channels=None, chunksize=100000, sorted_times=True, datalogger=None) -> tuple:
+    '''
+    Converts a logger file with the dataset IDs of its channels given in map_dict (see read_datasetmap and convert_campbell_to_ODMF_record)
+    and returns (records, stats), stats being a dictionary with the file, datalogger (the given name or the station name in the TOA5 header), 
+    table, number of rows read, number of records and seconds needed.
+    '''
+    started = time.perf_counter()
+    header = read_toa5_header(data_path)
+    if channels is None:
+        channels = mapped_channels(data_path, map_dict)
+    blocks = list(iter_campbell_blocks(data_path, starttime, endtime, chunksize, sorted_times, channels))
+    data = pd.concat(blocks, ignore_index=True) if blocks else pd.DataFrame(columns=["time", *channels])
+    records = block_to_long(data, map_dict)
 
-    start = pd.to_datetime(starttime)
-    end = pd.to_datetime(endtime)
-    LEDvolt_data = LEDvolt_data[(LEDvolt_data["time"] >= start) & (LEDvolt_data["time"] <= end)].reset_index(drop=True)
+    stats = {"data_path": data_path, "datalogger": datalogger or header["station"], "table": header.get("table"),
+             "rows": len(data), "records": len(records), "seconds": time.perf_counter() - started}
+    return records, stats
 
-    map = pd.read_excel(datasetmap)
-    filtered_map = map[map["Datalogger"] == datalogger]
-    map_dict = dict(zip(filtered_map["Channel_Name"], filtered_map["dataset_id"]))
-    LEDvolt_data = LEDvolt_data.rename(columns=map_dict)
 
-    LEDvolt_long = LEDvolt_data.melt(id_vars=["time"], var_name="dataset_id", value_name="value")
+def convert_campbell_files(data_paths, datasetmap, starttime, endtime, output_path=None, output_dir=None, output_format="csv", pattern="*.dat", max_workers=None, chunksize=100000, sorted_times=True, dataloggers=None) -> tuple:
+    '''
+    Converts the files of many loggers at once: the datasetmap is read once and the files are converted in parallel processes 
+    (see convert_campbell_file), each with the channels of its datalogger (see file_datalogger) that are mapped to a dataset.
+    Files that are not in TOA5 format or whose datalogger is not in the datasetmap are skipped.
+
+    Parameters:
+    - data_paths: Folder with the logger files or list of their paths.
+    - datasetmap: Path to the Excel file containing the mapping of channel names to dataset IDs for all dataloggers.
+    - starttime, endtime: Time span to convert (see convert_campbell_to_ODMF_record).
+    - output_path: Path of a file to write the records of all files to. The default is None.
+    - output_dir: Folder to write the records of each datalogger to (as <datalogger>.csv or <datalogger>.parquet). The default is None.
+    - output_format: "csv" or "parquet" (compressed, with the compact dtypes of RECORD_SCHEMA). The default is "csv".
+    - pattern: File name pattern of the logger files if data_paths is a folder. The default is "*.dat".
+    - max_workers: Number of processes. The default is None (number of cores), 1 converts the files in this process.
+    - chunksize, sorted_times: See iter_campbell_blocks.
+    - dataloggers: Name of the datalogger in the datasetmap per file path or file name pattern (e.g. {"CR300Series_*.dat": "T2"}). 
+      The default is None (the station name in the TOA5 header of each file).
+
+    Returns:
+    - (records, stats): The records of all files (None if they were written to output_path or output_dir) 
+      and a DataFrame with the datalogger, table, number of rows read, number of records and seconds needed per file.
+    '''
+    if isinstance(data_paths, str):
+        data_paths = sorted(glob.glob(os.path.join(data_paths, pattern)))
+    datasetmaps = read_datasetmaps(datasetmap)
+
+    files, map_dicts, file_dataloggers = [], [], []
+    for data_path in data_paths:
+        try:
+            header = read_toa5_header(data_path)
+        except (ValueError, UnicodeDecodeError) as error:
+            logging.warning(f"Skipped {data_path}: {error}")
+            continue
+        datalogger = file_datalogger(data_path, header, dataloggers)
+        if not datasetmaps.get(datalogger):
+            logging.warning(f"Skipped {data_path}: the datalogger {datalogger} is not in the datasetmap (use dataloggers to name the datalogger of the file)")
+            continue
+        files.append(data_path)
+        map_dicts.append(datasetmaps[datalogger])
+        file_dataloggers.append(datalogger)
+
+    if output_format not in ("csv", "parquet"):
+        raise ValueError(f"Unknown output format {output_format}, use 'csv' or 'parquet'")
+    arguments = (files, map_dicts, repeat(starttime), repeat(endtime), repeat(None), repeat(chunksize), repeat(sorted_times), file_dataloggers)
+    all_records, all_stats, written, parquet_writers = [], [], set(), {}
+    with stage("convert_logger_files", bytes_in=sum(os.path.getsize(data_path) for data_path in files)) as record:
+        executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers is None or max_workers > 1 else None
+        try:
+            for records, stats in (executor.map if executor else map)(convert_campbell_file, *arguments):
+                logging.info(f"{stats['data_path']} ({stats['datalogger']}, {stats['table']}): {stats['rows']} rows, {stats['records']} records in {stats['seconds']:.2f} s")
+                all_stats.append(stats)
+                path = output_path if output_path is not None else os.path.join(output_dir, f"{stats['datalogger']}.{output_format}") if output_dir is not None else None
+                if path is None:
+                    all_records.append(records)
+                elif output_format == "parquet":
+                    if path not in parquet_writers:
+                        parquet_writers[path] = pq.ParquetWriter(path, RECORD_SCHEMA, compression="zstd")
+                    with stage("write_parquet", rows_in=len(records)):
+                        parquet_writers[path].write_table(records_to_table(records))
+                else:
+                    with stage("write_csv", rows_in=len(records)):
+                        records.to_csv(path, mode="a" if path in written else "w", header=path not in written, index=False)
+                    written.add(path)
+        finally:
+            for writer in parquet_writers.values():
+                writer.close()
+            if executor:
+                executor.shutdown()
+        record.update(rows_in=sum(stats["rows"] for stats in all_stats), rows_out=sum(stats["records"] for stats in all_stats))
+
+    records = pd.concat(all_records, ignore_index=True) if all_records else None
+    return records, pd.DataFrame(all_stats, columns=["data_path", "datalogger", "table", "rows", "records", "seconds"])
+
 
-    LEDvolt_long["dataset_id"] = LEDvolt_long["dataset_id"].astype(int)
+def convert_campbell_LED_to_ODMF_record(data_path, datasetmap, datalogger, starttime, endtime, chunksize=100000, sorted_times=True):
+    '''
+    Convert Campbell Scientific LED voltage data (SEVolt_Avg(1) to SEVolt_Avg(12)) to a long format suitable for ODMF
+    (see convert_campbell_to_ODMF_record for the parameters).
+    
+    Returns:    
+    - A pandas DataFrame with colums "time", "dataset_id", and "value" as required for ODMF record import. 
+    '''
+    return convert_campbell_to_ODMF_record(data_path, datasetmap, datalogger, starttime, endtime, LED_CHANNELS, chunksize, sorted_times)
+
+def records_to_table(records) -> pa.Table:
+    '''Converts records (columns "time", "dataset_id" and "value") to a pyarrow table with the compact dtypes of RECORD_SCHEMA.'''
+    return pa.Table.from_pandas(records[["time", "dataset_id", "value"]], schema=RECORD_SCHEMA, preserve_index=False, safe=False)
+
+
+def write_records_parquet(records, path, compression="zstd") -> int:
+    '''
+    Writes records to a compressed Parquet file with the compact dtypes of RECORD_SCHEMA (int32 dataset_id, float32 value, time stamps) 
+    and returns the number of records written. records is a DataFrame or an iterable of DataFrames (e.g. iter_campbell_records), 
+    which are written one by one, so the memory needed does not depend on the number of records.
+    '''
+    if isinstance(records, pd.DataFrame):
+        records = [records]
+    rows = 0
+    with pq.ParquetWriter(path, RECORD_SCHEMA, compression=compression) as writer:
+        for block in records:
+            with stage("write_parquet", rows_in=len(block)):
+                writer.write_table(records_to_table(block))
+            rows += len(block)
+    return rows
+
+
+def upload_records_parquet(api, parquet_path, batch_size=100000, state_path=None, retries=3, retry_wait=10) -> int:
+    '''
+    Uploads the records of a Parquet file (see write_records_parquet) to ODMF with api.dataset.add_records_parquet in batches of batch_size records, 
+    reading only one batch at a time. A failed batch is tried again up to retries times, waiting retry_wait seconds (doubled each time). 
+    If it still fails the error is raised. With a state_path, the number of records uploaded from the file is stored in this json file after each batch,
+    and the next call with the same file continues after them (a file that changed since is uploaded from the start).
+
+    Parameters:
+    - api: odmfclient login.
+    - parquet_path: Path to the Parquet file with the columns "time", "dataset_id" and "value".
+    - batch_size: Number of records per request. The default is 100000.
+    - state_path: Path to the json file with the progress of the uploads. The default is None (no resume).
+    - retries: Number of times a failed batch is tried again. The default is 3.
+    - retry_wait: Seconds before the first retry. The default is 10.
+
+    Returns:
+    - The number of records uploaded by this call.
+    '''
+    key = os.path.abspath(parquet_path)
+    file_id = {"size": os.path.getsize(parquet_path), "mtime": os.path.getmtime(parquet_path)}
+    uploads = {}
+    if state_path is not None and os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            uploads = json.load(f)
+    entry = uploads.get(key)
+    if entry is not None and {"size": entry["size"], "mtime": entry["mtime"]} != file_id:
+        logging.warning(f"{parquet_path} changed since the last upload, it is uploaded from the start")
+        entry = None
+    done = entry["records"] if entry is not None else 0
+    if done:
+        logging.info(f"{done} records of {parquet_path} were uploaded before, the upload continues after them")
+
+    position = 0
+    uploaded = 0
+    for batch in pq.ParquetFile(parquet_path).iter_batches(batch_size=batch_size):
+        first = position
+        position += batch.num_rows
+        if position <= done:
+            continue
+        if first < done:
+            batch = batch.slice(done - first) # part of the batch was uploaded before
+        records = batch.to_pandas()
+        for attempt in range(retries + 1):
+            try:
+                with stage("upload_records", rows_in=len(records)):
+                    api.dataset.add_records_parquet(records)
+                break
+            except Exception as error:
+                if attempt == retries:
+                    raise
+                wait = retry_wait * 2**attempt
+                logging.warning(f"Upload of records {position - len(records)} to {position} of {parquet_path} failed ({error}), tried again in {wait} s")
+                time.sleep(wait)
+        uploaded += len(records)
+        if state_path is not None:
+            uploads[key] = {**file_id, "records": position}
+            with open(state_path, "w", encoding="utf-8") as f:
+                json.dump(uploads, f, indent=1)
+    logging.info(f"Uploaded {uploaded} records of {parquet_path}")
+    return uploaded
+
+
+class CampbellIngestState:
+    '''
+    Progress of the incremental conversion of growing logger files: for each file the byte offset of the first row that was not read yet,
+    the time stamp of the row before it, the last time stamp converted and the columns of the table, stored in a small json file. 
+    Delete the file (or an entry) to convert a file from the start again.
+
+    Parameters:
+    - path: Path to the json file. It is created by save() if it does not exist.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {} # absolute path of the logger file -> {"offset", "row_time", "last_time", "columns"}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.files = json.load(f)
+
+    def position(self, data_path, header) -> tuple:
+        '''
+        Returns (offset, last_time) at which the conversion of the file continues. Files that were replaced (the row before the offset
+        is not the row read last time) or whose columns changed (e.g. after a new logger program was sent) are read from their first data row again.
+        '''
+        entry = self.files.get(os.path.abspath(data_path))
+        if entry is None:
+            return header["data_offset"], None
+        last_time = pd.Timestamp(entry["last_time"]) if entry.get("last_time") else None
+        before_time = row_time(row_before(data_path, entry["offset"]))
+        stored_time = pd.Timestamp(entry["row_time"]) if entry.get("row_time") else pd.NaT # NaT if no data row was read yet
+        if entry["columns"] != header["columns"] or not (before_time == stored_time or (pd.isna(before_time) and pd.isna(stored_time))):
+            logging.warning(f"{data_path} was replaced or its table changed, it is read from the start (rows up to {last_time} are skipped)")
+            return header["data_offset"], last_time
+        return entry["offset"], last_time
+
+    def update(self, data_path, header, offset, row_time, last_time):
+        self.files[os.path.abspath(data_path)] = {"offset": offset, "row_time": None if pd.isna(row_time) else row_time.isoformat(), 
+                                                  "last_time": None if last_time is None else last_time.isoformat(), "columns": header["columns"]}
+
+    def save(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.files, f, indent=1)
+
+
+def iter_new_campbell_records(data_path, map_dict, state, channels=None, starttime=None, batch_bytes=16*1024**2):
+    '''
+    Converts only the rows appended to a growing TOA5 file since the last call (see CampbellIngestState) and yields them in the long format,
+    in batches of at most batch_bytes of the file. A last row that is still being written (without line end) is left for the next call.
+    The state is moved forward and saved after the caller has processed each batch, so a batch that failed (e.g. in the upload) is converted again next time.
+
+    Parameters:
+    - data_path: Path to the logger file.
+    - map_dict: Dataset IDs of the channels of the datalogger (channel name as key, see read_datasetmap).
+    - state: CampbellIngestState with the progress of the files.
+    - channels: Channels to convert. The default is None (all channels of the file in map_dict).
+    - starttime: Rows before this time are skipped (e.g. before the setup of the sensors was finished). The default is None.
+    - batch_bytes: Maximum number of bytes of the file converted at once.
+    '''
+    header = read_toa5_header(data_path)
+    if channels is None:
+        channels = mapped_channels(data_path, map_dict)
+    offset, last_time = state.position(data_path, header)
+    last_row_time = row_time(row_before(data_path, offset)) # NaT at the first data row
+    start = pd.to_datetime(starttime) if starttime is not None else None
+
+    with open(data_path, "rb") as f:
+        f.seek(offset)
+        while True:
+            with stage("read_logger_file") as record:
+                chunk = f.read(batch_bytes)
+                complete = chunk.rfind(b"\n") + 1 # only complete rows
+                if complete == 0:
+                    break
+                f.seek(offset + complete)
+                if chunk[:complete].strip():
+                    rows = toa5_rows_to_frame(pd.read_csv(io.BytesIO(chunk[:complete]), **toa5_read_options(header, channels)), channels)
+                else:
+                    rows = pd.DataFrame() # only blank lines, e.g. a line end written after the header or the last row
+                record.update(bytes_in=complete, rows_out=len(rows))
+
+            if rows.empty:
+                offset += complete
+                state.update(data_path, header, offset, last_row_time, last_time)
+                state.save()
+                continue
+
+            last_row_time = rows["time"].iloc[-1]
+            new_rows = pd.Series(True, index=rows.index)
+            if last_time is not None:
+                new_rows &= rows["time"] > last_time # rows converted before, e.g. if the file was replaced
+            if start is not None:
+                new_rows &= rows["time"] >= start
+            rows = rows[new_rows].reset_index(drop=True)
+            if not rows.empty:
+                yield block_to_long(rows, map_dict)
+                last_time = rows["time"].max() if last_time is None else max(last_time, rows["time"].max())
+            offset += complete
+            state.update(data_path, header, offset, last_row_time, last_time)
+            state.save()
+
+
+def watch_campbell_files(directory, datasetmap, state, pattern="*.dat", interval=60, rounds=None, starttime=None, batch_bytes=16*1024**2, dataloggers=None):
+    '''
+    Watch loop over the logger files in a directory: every interval seconds, the rows appended to each file since the last round 
+    are converted (see iter_new_campbell_records) and yielded as (data_path, records). The datasetmap is read once, the datalogger
+    of each file is looked up with file_datalogger.
+
+    Parameters:
+    - directory: Folder with the logger files.
+    - datasetmap: Path to the Excel file containing the mapping of channel names to dataset IDs.
+    - state: CampbellIngestState with the progress of the files.
+    - pattern: File name pattern of the logger files. The default is "*.dat".
+    - interval: Seconds between the rounds. The default is 60.
+    - rounds: Number of rounds after which the loop stops. The default is None (until it is interrupted).
+    - starttime, batch_bytes: See iter_new_campbell_records.
+    - dataloggers: Name of the datalogger in the datasetmap per file path or file name pattern (see convert_campbell_files). 
+      The default is None (the station name in the TOA5 header of each file).
+    '''
+    datasetmaps = read_datasetmaps(datasetmap)
+    skipped = set()
+    completed = 0
+    while rounds is None or completed < rounds:
+        for data_path in sorted(glob.glob(os.path.join(directory, pattern))):
+            try:
+                header = read_toa5_header(data_path)
+            except (ValueError, UnicodeDecodeError) as error:
+                if data_path not in skipped:
+                    logging.warning(f"Skipped {data_path}: {error}")
+                    skipped.add(data_path)
+                continue
+            datalogger = file_datalogger(data_path, header, dataloggers)
+            map_dict = datasetmaps.get(datalogger)
+            if not map_dict:
+                if data_path not in skipped:
+                    logging.warning(f"Skipped {data_path}: the datalogger {datalogger} is not in the datasetmap (use dataloggers to name the datalogger of the file)")
+                    skipped.add(data_path)
+                continue
+            for records in iter_new_campbell_records(data_path, map_dict, state, starttime=starttime, batch_bytes=batch_bytes):
+                yield data_path, records
+        completed += 1
+        if rounds is None or completed < rounds:
+            time.sleep(interval)
 
-    return LEDvolt_long
 
 if __name__ == "__main__":
 
@@ -69,10 +604,24 @@ if __name__ == "__main__":
     username = odmf_cfg["username"]
     password = odmf_cfg["password"]
 
-    T2_LED_log =convert_campbell_LED_to_ODMF_record(datalogger = "T2", data_path = T2_data_path, starttime = "2026-05-14 10:00:00", endtime = "2026-05-21 12:00:00", datasetmap = datasetmap_path)
+    with RunReport("convert_campbell", os.path.join(project_dir, "convert_campbell_report.json")): # use profile=True for a cProfile dump next to the report
+        # the records are written block by block, so the memory needed does not depend on the size of the logger file
+        output_path = os.path.join(project_dir, 'T2_LED_log.parquet')
+        T2_LED_log = iter_campbell_records(datalogger = "T2", data_path = T2_data_path, starttime = "2026-05-14 10:00:00", endtime = "2026-05-21 12:00:00", datasetmap = datasetmap_path, channels = LED_CHANNELS)
+        write_records_parquet(T2_LED_log, output_path)
+
+        # all logger files in the folder at once, one Parquet file per datalogger
+        #records, stats = convert_campbell_files(project_dir, datasetmap_path, "2026-05-14 10:00:00", "2026-05-21 12:00:00", output_dir=os.path.join(project_dir, "records"), output_format="parquet",
+        #                                        dataloggers={"CR300Series_*.dat": "T2"})
+        #print(stats)
 
-    T2_LED_log.to_csv(os.path.join(project_dir, 'T2_LED_log.csv'), index=False)
+        # incremental conversion of the growing logger files in the folder: only the rows appended since the last run are converted
+        #ingest_state = CampbellIngestState(os.path.join(project_dir, "campbell_ingest_state.json"))
+        #records_path = os.path.join(project_dir, "new_records.csv")
+        #for data_path, records in watch_campbell_files(project_dir, datasetmap_path, ingest_state, interval=600, dataloggers={"CR300Series_*.dat": "T2"}):
+        #    records.to_csv(records_path, mode="a", header=not os.path.exists(records_path), index=False)
     '''
-    with login('https://path/to/odmf', 'user', 'password') as api:
-        api.dataset.add_records_parquet(T2_LED_long)
+    with login(url, username, password) as api:
+        # an interrupted upload continues with the first batch that was not uploaded when it is started again
+        upload_records_parquet(api, output_path, batch_size=100000, state_path=os.path.join(project_dir, "upload_state.json"))
     '''
@@ -16,6 +16,10 @@ from a previous glossary or the ICASA Dictionary.
 import pandas as pd
 from openpyxl import load_workbook
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "export_ODMF"))
+from run_report import RunReport, stage
 
 
 def print_sheet_names (src_path: str) -> None:
@@ -50,13 +54,15 @@ def build_glossary_dataframe(
         - Row4 : value from Excel row 4
         - Sheet: name of the sheet the pair came from
     """
-    sheet_dict = pd.read_excel(
-            src_path,
-            sheet_name=None,
-            header=None,
-            dtype=str,
-            engine="openpyxl"
-        )
+    with stage("read_template", bytes_in=os.path.getsize(src_path)) as record:
+        sheet_dict = pd.read_excel(
+                src_path,
+                sheet_name=None,
+                header=None,
+                dtype=str,
+                engine="openpyxl"
+            )
+        record["rows_out"] = sum(len(raw_df) for raw_df in sheet_dict.values())
     
     all_blocks = []                         
 
@@ -86,7 +92,7 @@ def write_glossary_to_new_file(
     If the file already exists it will be overwritten.
     """
     # ExcelWriter with engine=openpyxl creates a fresh file when mode='w'
-    with pd.ExcelWriter(dest_path, engine="openpyxl", mode="w") as writer:
+    with stage("write_glossary", rows_in=len(glossary_df)), pd.ExcelWriter(dest_path, engine="openpyxl", mode="w") as writer:
         glossary_df.to_excel(writer, sheet_name=sheet_name, index=False)
     print(f"[DONE] Glossary saved to '{dest_path}' (sheet name: '{sheet_name}').")
     
@@ -126,11 +132,13 @@ def enrich_glossary_with_metadata(
         ``glossary_df`` with two additional rows for each variable.  If a variable cannot be found, the added rows contain
         empty strings.
     """
-    ref_glossary = pd.read_excel(
-        src_path,
-        sheet_name=glossary_sheet_name,
-        dtype=str, skiprows=header_row-1        
-    )
+    with stage("read_reference", bytes_in=os.path.getsize(src_path)) as record:
+        ref_glossary = pd.read_excel(
+            src_path,
+            sheet_name=glossary_sheet_name,
+            dtype=str, skiprows=header_row-1        
+        )
+        record["rows_out"] = len(ref_glossary)
     
     print(ref_glossary.info())
    
@@ -155,10 +163,10 @@ if __name__ == "__main__":
     output_path = os.path.join(BASE_DIR, output_file)
     dict_path = os.path.join(BASE_DIR, variables_all)
     
-    print_sheet_names(input_path)
-    glossary = build_glossary_dataframe(input_path, (2,3))
-    enriched = enrich_glossary_with_metadata(glossary, input_file)
-    enriched_with_dict = enrich_glossary_with_metadata(glossary_df=glossary, src_path=dict_path, glossary_sheet_name="Tabelle1", header_row=1)
-    enriched = enriched[["Sheet","Variable_Name", "Code_Query", "Description", "Unit_or_type",]]
-    write_glossary_to_new_file(enriched_with_dict, output_path)
-    
\ No newline at end of file
+    with RunReport("ICASA_glossary", os.path.join(BASE_DIR, "ICASA_glossary_report.json")): # use profile=True for a cProfile dump next to the report
+        print_sheet_names(input_path)
+        glossary = build_glossary_dataframe(input_path, (2,3))
+        enriched = enrich_glossary_with_metadata(glossary, input_file)
+        enriched_with_dict = enrich_glossary_with_metadata(glossary_df=glossary, src_path=dict_path, glossary_sheet_name="Tabelle1", header_row=1)
+        enriched = enriched[["Sheet","Variable_Name", "Code_Query", "Description", "Unit_or_type",]]
+        write_glossary_to_new_file(enriched_with_dict, output_path)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Regression checks of the export and conversion scripts on synthetic data (see synthetic.py), for behaviour that the 
+benchmarks do not cover: timeouts, incremental exports, the alignment of time bins, the dataloggers and blank lines of logger files 
+and formula cells of templates. No ODMF access is needed.
+
+    python regression_checks.py            # all checks
+    python regression_checks.py timeout    # checks whose name contains "timeout"
+"""
+
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "export_ODMF"))
+sys.path.append(os.path.join(ROOT_DIR, "Campbell"))
+
+import synthetic
+
+
+def check_timeout_bounds_wait(work_dir, max_workers):
+    '''A download that hangs raises a TimeoutError after the timeout, also without parallel downloads, and is not waited for.'''
+    import export_ODMF
+    api = synthetic.FakeODMF(synthetic.make_odmf_datasets(n_sites=2, days=1, valuetypes=(11,)))
+    api.dataset.delays[1] = 2.0
+    started = time.perf_counter()
+    try:
+        export_ODMF.fetch_datasets(api, [2, 1], "2025-01-01", "2025-01-01T23:59:59Z", max_workers=max_workers, timeout=0.3)
+    except TimeoutError:
+        pass
+    else:
+        raise AssertionError("no TimeoutError raised")
+    seconds = time.perf_counter() - started
+    assert seconds < 1.0, f"TimeoutError raised after {seconds:.2f} s"
+
+
+def check_incremental_site_export(work_dir):
+    '''
+    An incremental export of a site whose valuetypes write to two sheets downloads each dataset only from the day of its watermark,
+    also if the state file holds the watermarks of another export as well.
+    '''
+    import export_ODMF
+    template = os.path.join(work_dir, "template.xlsx")
+    synthetic.make_icasa_template(template, sheets={"SOIL_LAYERS": ["weather_station_id", "weather_date", "time_of_measurement", "soil_depth", "SWC"],
+                                                    "WEATHER_DAILY": ["weather_station_id", "weather_date", "TAVD", "TMAX", "TMIN"]})
+    datasets = synthetic.make_odmf_datasets(n_sites=2, days=6)
+    del datasets[1] # one dataset per valuetype at site 100: 2 (soil water content) and 3 (air temperature)
+    api = synthetic.FakeODMF(datasets)
+    state_path = os.path.join(work_dir, "state.json")
+    state = export_ODMF.ExportState(state_path)
+    state.update("OTHER_SHEET", {99: "2025-01-05T00:00:00"}) # watermark of another export sharing the file
+    export_ODMF.data_to_ICASA_by_site(api, 100, 7, "2025-01-01", "2025-01-03", template, date_col="weather_date", level_col="soil_depth", state=state)
+
+    api.dataset.value_requests.clear()
+    export_ODMF.data_to_ICASA_by_site(api, 100, 7, "2025-01-01", "2025-01-06", template, date_col="weather_date", level_col="soil_depth", 
+                                      state=export_ODMF.ExportState(state_path))
+    starts = {dsid: start for dsid, start, end in api.dataset.value_requests}
+    assert starts == {2: "2025-01-03", 3: "2025-01-03"}, f"downloads started at {starts}"
+
+
+def weekly_export(work_dir, name, windows=None, runs=(("2025-01-01", "2025-01-14"),)):
+    '''Exports weekly air temperatures of one site (see check_weekly_bins) and returns the WEATHER_DAILY sheet.'''
+    import export_ODMF
+    import pandas as pd
+    template = os.path.join(work_dir, f"{name}.xlsx")
+    synthetic.make_icasa_template(template)
+    api = synthetic.FakeODMF(synthetic.make_odmf_datasets(n_sites=1, days=14, valuetypes=(11,)))
+    state = export_ODMF.ExportState(os.path.join(work_dir, f"{name}.json")) if len(runs) > 1 else None
+    for start_date, end_date in runs:
+        export_ODMF.data_to_ICASA_by_valuetype(api, 11, 7, start_date, end_date, template, site_col="weather_station_id", date_col="weather_date",
+                                               overwrite=True, state=state, window_days=windows, agg_freq="W")
+    return pd.read_excel(template, sheet_name="WEATHER_DAILY", header=3)
+
+
+def check_weekly_bins(work_dir):
+    '''
+    Weekly aggregates are the same when the data is downloaded in windows shorter than a week or in two incremental runs 
+    that end in the middle of a week, as when the whole span is exported at once.
+    '''
+    expected = weekly_export(work_dir, "full")
+    assert len(expected) == 3, f"{len(expected)} weeks in the full export"
+    for name, kwargs in {"windows": {"windows": 3}, "incremental": {"runs": (("2025-01-01", "2025-01-08"), ("2025-01-01", "2025-01-14"))}}.items():
+        result = weekly_export(work_dir, name, **kwargs)
+        assert result.equals(expected), f"{name}: {len(result)} rows instead of {len(expected)}, or other values"
+
+
+def check_campbell_dataloggers(work_dir):
+    '''Logger files whose station name is not the datalogger name of the datasetmap are converted with the datalogger given per file name pattern.'''
+    from convert_campbell import CampbellIngestState, convert_campbell_files, watch_campbell_files
+    data_path = os.path.join(work_dir, "CR300Series_Minutentabelle.dat")
+    rows = synthetic.make_toa5_file(data_path, days=1)
+    with open(data_path, "r", encoding="utf-8") as f:
+        content = f.read().replace('"TOA5","T2"', '"TOA5","CR300Series"', 1) # station name as set in the logger
+    with open(data_path, "w", encoding="utf-8", newline="") as f:
+        f.write(content)
+    datasetmap = os.path.join(work_dir, "LED_radiation_sensors.xlsx")
+    synthetic.make_campbell_datasetmap(datasetmap)
+
+    records, stats = convert_campbell_files(work_dir, datasetmap, "2026-05-14", "2026-05-15", max_workers=1)
+    assert stats.empty, "file converted with the station name"
+    records, stats = convert_campbell_files(work_dir, datasetmap, "2026-05-14", "2026-05-15", max_workers=1, dataloggers={"CR300Series_*.dat": "T2"})
+    assert list(stats["datalogger"]) == ["T2"] and stats["rows"].iloc[0] == rows, f"converted: {stats.to_dict('records')}"
+    watched = list(watch_campbell_files(work_dir, datasetmap, CampbellIngestState(os.path.join(work_dir, "state.json")), rounds=1, dataloggers={data_path: "T2"}))
+    assert sum(len(records) for _, records in watched) == len(records), "watch mode converted other records"
+
+
+def check_campbell_blank_lines(work_dir):
+    '''
+    Watching a logger file whose new part holds no data row, only a blank line after the header or after the last row, 
+    converts nothing and continues behind it without reading the file from the start again, and the rows written later are converted.
+    '''
+    from convert_campbell import CampbellIngestState, iter_new_campbell_records, read_datasetmap, read_toa5_header
+    data_path = os.path.join(work_dir, "T2_Minutentabelle.dat")
+    synthetic.make_toa5_file(data_path, days=1, nan_fraction=0)
+    with open(data_path, "rb") as f:
+        lines = f.read().splitlines(keepends=True) # 4 header rows, then data rows with 12 channels
+    datasetmap = os.path.join(work_dir, "LED_radiation_sensors.xlsx")
+    synthetic.make_campbell_datasetmap(datasetmap)
+    map_dict = read_datasetmap(datasetmap, "T2")
+    cases = { # name -> (parts appended to the file one after the other, records expected from each part)
+        "header_only": ([lines[:4] + [b"\n"], lines[4:14]], [0, 120]),
+        "trailing_newline": ([lines[:14], [b"\n"], lines[14:24]], [120, 0, 120]),
+    }
+    for name, (parts, expected) in cases.items():
+        state = CampbellIngestState(os.path.join(work_dir, f"{name}.json"))
+        open(data_path, "wb").close()
+        converted = []
+        for part in parts:
+            with open(data_path, "ab") as f:
+                f.write(b"".join(part))
+            converted.append(sum(len(records) for records in iter_new_campbell_records(data_path, map_dict, state)))
+            offset, last_time = state.position(data_path, read_toa5_header(data_path))
+            assert offset == os.path.getsize(data_path), f"{name}: continues at byte {offset} of {os.path.getsize(data_path)}"
+        assert converted == expected, f"{name}: {converted} records converted instead of {expected}"
+
+def add_formula(path, sheet_name, cell, formula, cached_value):
+    '''Writes a formula into a cell of an xlsx file together with the value Excel would have calculated for it (openpyxl stores no values of formulas).'''
+    from openpyxl import load_workbook
+    workbook = load_workbook(path)
+    workbook[sheet_name][cell] = f"={formula}"
+    workbook.save(path)
+    with zipfile.ZipFile(path) as archive:
+        contents = {name: archive.read(name) for name in archive.namelist()}
+    for name, content in contents.items():
+        if name.startswith("xl/worksheets/"):
+            contents[name] = content.replace(f'<c r="{cell}"><f>{formula}</f><v /></c>'.encode(), f'<c r="{cell}"><f>{formula}</f><v>{cached_value}</v></c>'.encode())
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, content in contents.items():
+            archive.writestr(name, content)
+
+
+def check_formula_values(work_dir):
+    '''Template sheets are read with the calculated values of formula cells, as by pd.read_excel.'''
+    import pandas as pd
+    from export_ODMF import ICASAWorkbook
+    from icasa_staging import ICASAStaging
+    template = os.path.join(work_dir, "template.xlsx")
+    synthetic.make_icasa_template(template, existing_rows=3)
+    add_formula(template, "WEATHER_DAILY", "D5", "E5+10", 42.5)
+    expected = pd.read_excel(template, sheet_name="WEATHER_DAILY", skiprows=3)
+    assert expected["TMAX"].iloc[0] == 42.5, "formula value not stored in the test template"
+    for name, workbook in {"ICASAWorkbook": ICASAWorkbook(template), "ICASAStaging": ICASAStaging(template, os.path.join(work_dir, "staging"))}.items():
+        value = workbook.read_sheet("WEATHER_DAILY")["TMAX"].iloc[0]
+        assert value == 42.5, f"{name} read {value!r} instead of 42.5"
+
+
+def check_window_metadata(work_dir):
+    '''A windowed export requests the dataset object of each dataset once, not once per window.'''
+    import export_ODMF
+    api = synthetic.FakeODMF(synthetic.make_odmf_datasets(n_sites=2, days=20, valuetypes=(11,)))
+    windows = list(export_ODMF.data_by_valuetype_in_windows(api, 11, 7, "2025-01-01", "2025-01-20", window_days=5))
+    assert len(windows) == 4 and sum(len(window) for window in windows) == sum(len(dataset["data"]) for dataset in api.dataset.datasets.values())
+    assert api.dataset.calls["get"] == 2, f"{api.dataset.calls['get']} dataset objects requested for 2 datasets"
+
+
+def check_mapped_site_datasets(work_dir):
+    '''
+    The datasets of a site are selected from a built mapping, requesting only the dataset objects of the datasets with a sheet 
+    in the template, and the same datasets are selected as without the mapping.
+    '''
+    import export_ODMF
+    from icasa_mapping import ICASAMapping
+    template = os.path.join(work_dir, "template.xlsx")
+    synthetic.make_icasa_template(template, sheets={"WEATHER_DAILY": synthetic.TEMPLATE_SHEETS["WEATHER_DAILY"]}) # no sheet of SWC
+    api = synthetic.FakeODMF(synthetic.make_odmf_datasets(n_sites=2, days=1))
+    workbook = export_ODMF.ICASAWorkbook(template)
+    expected = export_ODMF.select_mapped_datasets(api, 100, 7, workbook, ICASAMapping())
+    mapping = ICASAMapping().build(api, 7)
+    api.dataset.calls["get"] = 0
+    selected = export_ODMF.select_mapped_datasets(api, 100, 7, workbook, mapping)
+    assert selected == expected and list(selected) == [3], f"selected datasets {list(selected)} instead of {list(expected)}"
+    assert api.dataset.calls["get"] == 1, f"{api.dataset.calls['get']} dataset objects requested for 1 selected dataset"
+
+
+CHECKS = { # name -> check(work_dir)
+    "timeout_one_worker": lambda work_dir: check_timeout_bounds_wait(work_dir, 1),
+    "timeout_four_workers": lambda work_dir: check_timeout_bounds_wait(work_dir, 4),
+    "incremental_site_export": check_incremental_site_export,
+    "weekly_bins": check_weekly_bins,
+    "window_metadata": check_window_metadata,
+    "mapped_site_datasets": check_mapped_site_datasets,
+    "campbell_dataloggers": check_campbell_dataloggers,
+    "campbell_blank_lines": check_campbell_blank_lines,
+    "formula_values": check_formula_values,
+}
+
+
+def main(argv=None):
+    selected = argv if argv is not None else sys.argv[1:]
+    failed = 0
+    for name, check in CHECKS.items():
+        if selected and not any(part in name for part in selected):
+            continue
+        with tempfile.TemporaryDirectory() as work_dir:
+            try:
+                check(work_dir)
+                print(f"{name:40} ok")
+            except AssertionError as error:
+                failed += 1
+                print(f"{name:40} FAILED: {error}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
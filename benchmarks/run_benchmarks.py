@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the export and conversion scripts on synthetic data (see synthetic.py), to measure whether a change
+makes them faster or leaner. No ODMF access, credentials or real templates are needed.
+
+Measured are data_to_ICASA_by_valuetype, data_to_ICASA_by_site, the data_transform.py flow,
+convert_campbell_LED_to_ODMF_record and build_glossary_dataframe, each at several sizes. For every benchmark and size
+the best wall time of the repeats, the rows processed per second and the peak memory allocated by python and numpy
+(tracemalloc, measured in a separate run) are stored in results/<label>.json.
+
+    python run_benchmarks.py                                  # all benchmarks, sizes small and medium
+    python run_benchmarks.py --sizes small medium large --latency 0.02 --label before_change
+    python run_benchmarks.py --compare results/before_change.json results/after_change.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "export_ODMF"))
+sys.path.append(os.path.join(ROOT_DIR, "Campbell"))
+sys.path.append(ROOT_DIR)
+
+import synthetic
+
+
+# parameters of each benchmark per size
+SIZES = {
+    "small": {"sites": 3, "days": 7, "template_rows": 50, "treatments": 20, "dates": 5, "logger_days": 2, "sheets": 5, "columns": 30},
+    "medium": {"sites": 10, "days": 30, "template_rows": 500, "treatments": 100, "dates": 20, "logger_days": 14, "sheets": 20, "columns": 80},
+    "large": {"sites": 30, "days": 120, "template_rows": 5000, "treatments": 400, "dates": 50, "logger_days": 60, "sheets": 60, "columns": 150},
+}
+
+
+def bench_by_valuetype(work_dir, size, latency):
+    '''Prepares an export of both synthetic valuetypes over all sites and returns (run, number of values downloaded).'''
+    import export_ODMF
+    template = os.path.join(work_dir, "template.xlsx")
+    synthetic.make_icasa_template(template, existing_rows=size["template_rows"], sites=tuple(range(100, 100 + size["sites"])))
+    api = synthetic.FakeODMF(synthetic.make_odmf_datasets(n_sites=size["sites"], days=size["days"]), latency)
+    end_date = (pd.Timestamp("2025-01-01") + pd.Timedelta(days=size["days"] - 1)).strftime("%Y-%m-%d")
+
+    def run():
+        export_ODMF.data_to_ICASA_by_valuetype(api, 10, 7, "2025-01-01", end_date, template, level_col="me_soil_layer_top_depth")
+        export_ODMF.data_to_ICASA_by_valuetype(api, 11, 7, "2025-01-01", end_date, template, site_col="weather_station_id", date_col="weather_date")
+        return api.dataset.rows_served
+    return run
+
+
+def bench_by_site(work_dir, size, latency):
+    '''Prepares an export of a weather station with a long time series and returns the run.'''
+    import export_ODMF
+    template = os.path.join(work_dir, "template.xlsx")
+    synthetic.make_icasa_template(template, existing_rows=size["template_rows"])
+    days = size["days"] * size["sites"]
+    api = synthetic.FakeODMF(synthetic.make_odmf_datasets(n_sites=2, days=days, valuetypes=(11,)), latency) # only site 100 is exported
+    end_date = (pd.Timestamp("2025-01-01") + pd.Timedelta(days=days - 1)).strftime("%Y-%m-%d")
+
+    def run():
+        export_ODMF.data_to_ICASA_by_site(api, 100, 7, "2025-01-01", end_date, template, date_col="weather_date")
+        return api.dataset.rows_served
+    return run
+
+
+def run_data_transform(script_path, settings):
+    '''Runs data_transform.py with the given settings (e.g. input_file) instead of the values written in the script.'''
+    with open(script_path, "r", encoding="utf-8") as f:
+        source = f.read()
+    for name, value in settings.items():
+        source = re.sub(rf"^{name} = .*$", lambda match: f"{name} = {value!r}", source, count=1, flags=re.MULTILINE)
+    namespace = {"__name__": "__main__", "__file__": script_path}
+    exec(compile(source, script_path, "exec"), namespace)
+
+
+def bench_data_transform(work_dir, size, latency):
+    '''Prepares a run of data_transform.py with replicates merged into FINAL_GROWTH and returns the run.'''
+    input_file = os.path.join(work_dir, "input.xlsx")
+    template = os.path.join(work_dir, "template.xlsx")
+    rows = synthetic.make_transform_input(input_file, n_treatments=size["treatments"], n_dates=size["dates"])
+    synthetic.make_icasa_template(template, existing_rows=size["template_rows"], sites=tuple(range(1, size["treatments"] + 1)), start="2025-06-01")
+    settings = {"input_file": input_file, "input_sheet": "Straw", "template_file": template, "template_sheet": "FINAL_GROWTH"}
+
+    def run():
+        run_data_transform(os.path.join(ROOT_DIR, "data_transform.py"), settings)
+        return rows
+    return run
+
+
+def bench_convert_campbell(work_dir, size, latency):
+    '''Prepares the conversion of a synthetic minute table to ODMF records and returns the run.'''
+    from convert_campbell import convert_campbell_LED_to_ODMF_record
+    data_path = os.path.join(work_dir, "CR300Series_Minutentabelle.dat")
+    datasetmap = os.path.join(work_dir, "LED_radiation_sensors.xlsx")
+    rows = synthetic.make_toa5_file(data_path, days=size["logger_days"])
+    synthetic.make_campbell_datasetmap(datasetmap)
+
+    def run():
+        convert_campbell_LED_to_ODMF_record(data_path, datasetmap, "T2", "2026-05-14 06:00:00", "2026-12-31 00:00:00")
+        return rows
+    return run
+
+
+def bench_glossary(work_dir, size, latency):
+    '''Prepares the glossary of a template with many sheets and columns and returns the run.'''
+    from ICASA_glossary import build_glossary_dataframe
+    template = os.path.join(work_dir, "template.xlsx")
+    synthetic.make_icasa_template(template, existing_rows=size["template_rows"], extra_columns=size["columns"], extra_sheets=size["sheets"])
+
+    def run():
+        return len(build_glossary_dataframe(template))
+    return run
+
+
+BENCHMARKS = {
+    "data_to_ICASA_by_valuetype": bench_by_valuetype,
+    "data_to_ICASA_by_site": bench_by_site,
+    "data_transform": bench_data_transform,
+    "convert_campbell_LED_to_ODMF_record": bench_convert_campbell,
+    "build_glossary_dataframe": bench_glossary,
+}
+
+
+def measure(prepare, size, latency, repeat=3, memory=True) -> dict:
+    '''
+    Runs the benchmark repeat times, each time on freshly generated inputs (not timed), and once more with tracemalloc for the peak memory.
+    '''
+    times = []
+    rows = None
+    for _ in range(repeat + memory):
+        tracing = memory and len(times) == repeat
+        with tempfile.TemporaryDirectory() as work_dir:
+            run = prepare(work_dir, size, latency)
+            if tracing:
+                tracemalloc.start()
+            started = time.perf_counter()
+            rows = run()
+            seconds = time.perf_counter() - started
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                times.append(seconds)
+    result = {"seconds": min(times), "rows": rows, "rows_per_second": rows / min(times) if min(times) > 0 else None}
+    if memory:
+        result["python_peak_bytes"] = peak
+    return result
+
+
+def version_label() -> str:
+    '''Returns the short git hash of the working tree (with a + if there are uncommitted changes), or "unknown".'''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("+" if dirty else "")
+
+
+def compare(old_path, new_path):
+    '''Prints the wall times and peak memory of two result files side by side.'''
+    with open(old_path, "r", encoding="utf-8") as f:
+        old = {(r["benchmark"], r["size"]): r for r in json.load(f)["results"]}
+    with open(new_path, "r", encoding="utf-8") as f:
+        new = {(r["benchmark"], r["size"]): r for r in json.load(f)["results"]}
+    print(f"{'benchmark':38} {'size':7} {'old s':>9} {'new s':>9} {'speedup':>8} {'old MB':>8} {'new MB':>8}")
+    for key in old:
+        if key not in new:
+            continue
+        o, n = old[key], new[key]
+        speedup = o["seconds"] / n["seconds"] if n["seconds"] else float("nan")
+        old_mb = o.get("python_peak_bytes", float("nan")) / 1e6
+        new_mb = n.get("python_peak_bytes", float("nan")) / 1e6
+        print(f"{key[0]:38} {key[1]:7} {o['seconds']:9.3f} {n['seconds']:9.3f} {speedup:8.2f} {old_mb:8.1f} {new_mb:8.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the ODMF/ICASA scripts on synthetic data")
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["small", "medium"])
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark and size (the best is kept)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request of the fake ODMF API")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--label", default=None, help="name of the result file (default: git hash and time)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files instead of running")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    version = version_label()
+    label = args.label or f"{version}_{datetime.datetime.now():%Y%m%d_%H%M%S}"
+    results = []
+    for name in args.benchmarks:
+        for size_name in args.sizes:
+            result = measure(BENCHMARKS[name], SIZES[size_name], args.latency, args.repeat, not args.no_memory)
+            results.append({"benchmark": name, "size": size_name, **result})
+            print(f"{name:38} {size_name:7} {result['seconds']:9.3f} s {result['rows']:>10} rows"
+                  + (f" {result['python_peak_bytes'] / 1e6:8.1f} MB" if "python_peak_bytes" in result else ""))
+
+    result_dir = os.path.join(BENCHMARK_DIR, "results")
+    os.makedirs(result_dir, exist_ok=True)
+    result_path = os.path.join(result_dir, f"{label}.json")
+    with open(result_path, "w", encoding="utf-8") as f:
+        json.dump({"label": label, "version": version, "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "python": platform.python_version(), "pandas": pd.__version__, "latency": args.latency,
+                   "repeat": args.repeat, "sizes": {name: SIZES[name] for name in args.sizes}, "results": results}, f, indent=1)
+    print(f"Results saved to {result_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic inputs for the benchmarks (run_benchmarks.py): an in-process stand-in for the ODMF API,
+ICASA templates, input sheets for data_transform.py and Campbell TOA5 logger files.
+
+All generators are deterministic for a given seed, so runs of different versions of the scripts can be compared.
+"""
+
+import csv
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+
+# ODMF comments of the synthetic valuetypes, in the format read by extract_ICASA_info
+VALUETYPE_COMMENTS = {
+    10: "volumetric soil water content\nICASA: SWC*100, mean",
+    11: "air temperature\nICASA: TAVD, mean\nICASA: TMAX, max\nICASA: TMIN, min",
+}
+
+# data sheets of the synthetic ICASA template: sheet name -> column names in row 4
+TEMPLATE_SHEETS = {
+    "SOIL_LAYERS": ["sampling_location_number", "date_of_measurement", "time_of_measurement", "me_soil_layer_top_depth", "SWC"],
+    "WEATHER_DAILY": ["weather_station_id", "weather_date", "TAVD", "TMAX", "TMIN"],
+    "FINAL_GROWTH": ["treatment_number", "date_of_measurement", "RP", "PHTD", "CWAD", "CWAD_stdev", "number_of_samples"],
+}
+
+
+# levels (e.g. soil depths) at which each synthetic valuetype is measured at every site
+VALUETYPE_LEVELS = {
+    10: (10, 30),
+    11: (None,),
+}
+
+
+def make_odmf_datasets(n_sites=3, days=7, freq="10min", valuetypes=(10, 11), start="2025-01-01", first_site_id=100, seed=0) -> dict:
+    '''
+    Returns synthetic ODMF datasets: dataset_id -> {"meta": dataset object, "data": pd.DataFrame with time and value}.
+    Every site has one dataset per valuetype and level (see VALUETYPE_LEVELS).
+    '''
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start, periods=int(pd.Timedelta(days=days) / pd.Timedelta(freq)), freq=freq)
+    datasets = {}
+    dataset_id = 1
+    for site in range(n_sites):
+        for valuetype_id in valuetypes:
+            for level in VALUETYPE_LEVELS.get(valuetype_id, (None,)):
+                datasets[dataset_id] = {
+                    "meta": {"id": dataset_id, "site": {"id": first_site_id + site}, "level": level,
+                             "valuetype": {"id": valuetype_id, "comment": VALUETYPE_COMMENTS.get(valuetype_id, "")}},
+                    "data": pd.DataFrame({"time": times, "value": rng.normal(20, 5, len(times))}),
+                }
+                dataset_id += 1
+    return datasets
+
+
+class FakeDatasetAPI:
+    '''Stand-in for api.dataset of an odmfclient login, serving synthetic datasets with a fixed latency per request.'''
+
+    def __init__(self, datasets, latency=0.0):
+        self.datasets = datasets
+        self.latency = latency
+        self.calls = {"list": 0, "get": 0, "values": 0, "add_records": 0}
+        self.rows_served = 0
+        self.delays = {} # dataset_id -> additional seconds of values_parquet, to test timeouts
+        self.value_requests = [] # (dsid, start, end) of each values_parquet call
+        self.records = [] # DataFrames received by add_records_parquet
+        self.fail_uploads = set() # numbers of the add_records_parquet calls (from 1) that raise a ConnectionError, to test resuming
+        self._lock = threading.Lock()
+
+    def _request(self, kind, rows=0):
+        with self._lock:
+            self.calls[kind] += 1
+            self.rows_served += rows
+        if self.latency:
+            time.sleep(self.latency)
+
+    def list(self, valuetype=None, project=None, site=None, **kwargs) -> list:
+        self._request("list")
+        return [dataset_id for dataset_id, dataset in self.datasets.items()
+                if (valuetype is None or dataset["meta"]["valuetype"]["id"] == valuetype)
+                and (site is None or dataset["meta"]["site"]["id"] == site)]
+
+    def __call__(self, dsid):
+        self._request("get")
+        return self.datasets[dsid]["meta"]
+
+    def values_parquet(self, dsid, start=None, end=None) -> pd.DataFrame:
+        data = self.datasets[dsid]["data"]
+        selected = pd.Series(True, index=data.index)
+        if start is not None:
+            selected &= data["time"] >= pd.Timestamp(start).tz_localize(None)
+        if end is not None:
+            selected &= data["time"] <= pd.Timestamp(end).tz_localize(None)
+        values = data[selected].reset_index(drop=True)
+        self._request("values", len(values))
+        with self._lock:
+            self.value_requests.append((dsid, start, end))
+        if dsid in self.delays:
+            time.sleep(self.delays[dsid])
+        return values
+
+    def add_records_parquet(self, records):
+        self._request("add_records")
+        if self.calls["add_records"] in self.fail_uploads:
+            raise ConnectionError(f"Synthetic failure of upload {self.calls['add_records']}")
+        self.records.append(records.copy())
+
+
+class FakeODMF:
+    '''In-process stand-in for an odmfclient login (api.dataset.list, api.dataset(dsid), api.dataset.values_parquet and api.dataset.add_records_parquet).'''
+
+    def __init__(self, datasets, latency=0.0):
+        self.dataset = FakeDatasetAPI(datasets, latency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def make_icasa_template(path, sheets=None, existing_rows=0, extra_columns=0, extra_sheets=0, sites=(100,), start="2025-01-01"):
+    '''
+    Writes a synthetic ICASA template with a ReadMe sheet and the given data sheets (column names in row 4).
+
+    Parameters
+    ----------
+    path : string
+        Path of the xlsx file.
+    sheets : dict, optional
+        Sheet name -> column names. The default is TEMPLATE_SHEETS.
+    existing_rows : integer, optional
+        Number of data rows already stored in each data sheet (daily rows from start for the given sites). The default is 0.
+    extra_columns : integer, optional
+        Number of additional (empty) variable columns per sheet. The default is 0.
+    extra_sheets : integer, optional
+        Number of additional data sheets with extra_columns variables each (e.g. for the glossary). The default is 0.
+    sites : tuple of integers, optional
+        Site (or treatment) numbers used for the existing rows. The default is (100,).
+    start : string, optional
+        Date of the first existing row. The default is "2025-01-01".
+
+    '''
+    sheets = dict(TEMPLATE_SHEETS if sheets is None else sheets)
+    for number in range(extra_sheets):
+        sheets[f"EXTRA_{number + 1}"] = ["treatment_number", "date_of_measurement"]
+
+    workbook = Workbook()
+    readme = workbook.active
+    readme.title = "ReadMe"
+    for line in ["Synthetic ICASA template", "generated by benchmarks/synthetic.py", "for benchmarks only", "no real data"]:
+        readme.append([line])
+
+    rng = np.random.default_rng(0)
+    dates = pd.date_range(start, periods=max(1, -(-existing_rows // max(1, len(sites)))), freq="D")
+    for sheet_name, columns in sheets.items():
+        columns = list(columns) + [f"{sheet_name[:4]}_VAR_{i + 1}" for i in range(extra_columns)]
+        ws = workbook.create_sheet(sheet_name)
+        ws.append(["Synthetic data sheet", sheet_name])
+        ws.append(["Description"] * len(columns))
+        ws.append(["unit"] * len(columns))
+        ws.append(columns)
+        rows = 0
+        for date in dates:
+            for site in sites:
+                if rows >= existing_rows:
+                    break
+                row = [None] * len(columns)
+                row[0] = site
+                row[1] = date.to_pydatetime()
+                row[-1] = round(float(rng.normal(20, 5)), 3) # last variable column is filled
+                ws.append(row)
+                rows += 1
+    workbook.save(path)
+
+
+def make_transform_input(path, sheet_name="Straw", n_treatments=20, n_dates=5, replicates=2, start="2025-06-01", seed=0):
+    '''Writes a synthetic input sheet for data_transform.py (treatment_number, date_of_measurement, RP and two variables).'''
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, periods=n_dates, freq="7D")
+    rows = [(treatment, date, replicate) for date in dates for treatment in range(1, n_treatments + 1) for replicate in range(1, replicates + 1)]
+    data = pd.DataFrame(rows, columns=["treatment_number", "date_of_measurement", "RP"])
+    data["PHTD"] = rng.normal(1, 0.1, len(data)).round(3)
+    data["CWAD"] = rng.normal(5, 1, len(data)).round(3)
+    data["comment"] = "x"
+    data.to_excel(path, sheet_name=sheet_name, index=False)
+    return len(data)
+
+
+def make_toa5_file(path, days=1, interval="1min", channels=12, start="2026-05-14 00:00:00", nan_fraction=0.01, seed=0) -> int:
+    '''
+    Writes a synthetic Campbell Scientific TOA5 file (CR300 minute table with TIMESTAMP, RECORD, BattV and SEVolt_Avg(1..channels))
+    and returns the number of data rows.
+    '''
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start, periods=int(pd.Timedelta(days=days) / pd.Timedelta(interval)), freq=interval)
+    columns = ["TIMESTAMP", "RECORD", "BattV_Min"] + [f"SEVolt_Avg({i})" for i in range(1, channels + 1)]
+    values = rng.normal(1.2, 0.3, (len(times), channels)).round(4)
+    values[rng.random(values.shape) < nan_fraction] = np.nan
+
+    data = pd.DataFrame(values, columns=columns[3:])
+    data.insert(0, "BattV_Min", rng.normal(12.5, 0.1, len(times)).round(2))
+    data.insert(0, "RECORD", np.arange(len(times)))
+    data.insert(0, "TIMESTAMP", times.strftime("%Y-%m-%d %H:%M:%S"))
+
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write('"TOA5","T2","CR300","12345","CR300.Std.10.03","CPU:LED.CR300","12345","Minutentabelle"\n')
+        f.write(",".join(f'"{column}"' for column in columns) + "\n")
+        f.write(",".join(f'"{unit}"' for unit in ["TS", "RN", "Volts"] + ["mV"] * channels) + "\n")
+        f.write(",".join(f'"{process}"' for process in ["", "", "Min"] + ["Avg"] * channels) + "\n")
+        data.to_csv(f, header=False, index=False, na_rep="NAN", quoting=csv.QUOTE_NONNUMERIC) # time stamps and NAN are quoted as written by the logger
+    return len(data)
+
+
+def make_campbell_datasetmap(path, datalogger="T2", channels=12, first_dataset_id=1000):
+    '''Writes the Excel mapping of logger channels to ODMF dataset ids used by convert_campbell_LED_to_ODMF_record.'''
+    pd.DataFrame({
+        "Datalogger": [datalogger] * channels,
+        "Channel_Name": [f"SEVolt_Avg({i})" for i in range(1, channels + 1)],
+        "dataset_id": range(first_dataset_id, first_dataset_id + channels),
+    }).to_excel(path, index=False)
@@ -86,17 +86,50 @@ unit_change = {}
 
 overwrite_values = False
 
+"""
+#specify whether the merged data should be kept in a staging store instead of writing the template_file on every run
+#(a folder with one Parquet file per sheet or a SQLite file, see export_ODMF/icasa_staging.py). 
+#Data of several runs accumulates in the staging store. The template_file is only written if render_template is True,
+#e.g. for the last run before the template is handed out. Use staging_path = None to write the template_file directly.
+"""
+
+staging_path = None
+staging_backend = "parquet"
+render_template = True
+
+"""
+#optionally provide a path for a json report with the time, rows and memory of each step of the run 
+#(see export_ODMF/run_report.py), e.g. "H:/Data/data_transform_report.json"
+"""
+
+report_file = None
 
 
+import os
+import sys
 import pandas as pd
 from openpyxl import load_workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "export_ODMF"))
+from icasa_merge import upsert_rows
+from icasa_staging import ICASAStaging, write_combined_data_to_sheet
+from run_report import RunReport, stage, frame_bytes
+
+report = RunReport("data_transform", report_file).start()
 
 # imporating the data, excluding the top rows from the template
 
-input_data = pd.read_excel(input_file, sheet_name = input_sheet)
+with stage("read_input", bytes_in=os.path.getsize(input_file)) as record:
+    input_data = pd.read_excel(input_file, sheet_name = input_sheet)
+    record["rows_out"] = len(input_data)
 
-template_data = pd.read_excel(template_file, sheet_name=template_sheet, skiprows=3)
+with stage("read_template") as record:
+    if staging_path is not None:
+        staging = ICASAStaging(template_file, staging_path, staging_backend)
+        template_data = staging.read_sheet(template_sheet)
+    else:
+        template_data = pd.read_excel(template_file, sheet_name=template_sheet, skiprows=3)
+    record["rows_out"] = len(template_data)
 
 #rename input data columns and/or rows
 
@@ -171,41 +204,24 @@ else:
 
 data_cols = [col for col in common_cols_2 if col not in keys]
 
-merged_data = pd.merge(template_data, input_data_subset, on = keys, how = 'outer', suffixes = ("_t", "_i"))
-
-if overwrite_values:
-    for col in data_cols:
-        merged_data[col] = merged_data[f"{col}_i"].combine_first(merged_data[f"{col}_t"]) #creates combination columns that have the original names (stored in data_cols), containing value from input, only if input has no value, use value from template
-else:
-    for col in data_cols:
-        merged_data[col] = merged_data[f"{col}_t"].combine_first(merged_data[f"{col}_i"]) #creates combination columns that have the original names (stored in data_cols), containing value from template, only if template was no value, use value from input
-    
-final_data = merged_data[template_data.columns] #merged data contains combination column and the columns with indexes, keep only keys and combination columns and empty columns from template sheet
-
-# write the new template into the old excel sheet (and format the columns)
-
-# Load workbook and worksheet
-wb = load_workbook(template_file)
-ws = wb[template_sheet]
-
-# Write new data starting at row 4
-for r_idx, row in enumerate(dataframe_to_rows(final_data, index=False, header=True), start=4):
-    for c_idx, value in enumerate(row, start=1):
-        ws.cell(row=r_idx, column=c_idx, value=value)
-
-# get headers
-header = [cell.value for cell in ws[4]]
-
-# date_of_measurement column formatting
-if "date_of_measurement" in common_cols_2:
-    date_col_idx = header.index("date_of_measurement") + 1  # 1-based indexing
-    for row in ws.iter_rows(min_row=5, min_col=date_col_idx, max_col=date_col_idx):
-        row[0].number_format = "yyyy-mm-dd"
-
-# time_of_measurement column formatting
-if "time_of_measurement" in common_cols_2:
-    time_col_idx = header.index("time_of_measurement") + 1
-    for row in ws.iter_rows(min_row=5, min_col=time_col_idx, max_col=time_col_idx):
-        row[0].number_format = "hh:mm:ss"
-
-wb.save(template_file)       
\ No newline at end of file
+with stage("merge", rows_in=len(input_data_subset), bytes_in=frame_bytes(input_data_subset)) as record:
+    final_data, inserted, updated = upsert_rows(template_data, input_data_subset, keys, data_cols, overwrite_values) #updates template rows with matching keys in place (values from input only replace template values if overwrite_values) and adds the other rows, keeping only the columns of the template sheet
+    record.update(rows_out=len(final_data), rows_inserted=inserted, rows_updated=updated)
+print(f"{inserted} rows inserted, {updated} rows updated in {template_sheet}")
+
+# keep the result in the staging store and render the template if requested, or write the new template into the old excel sheet directly
+
+with stage("write_template", rows_in=len(final_data)):
+    if staging_path is not None:
+        staging.write_sheet(final_data, template_sheet)
+        staging.save()
+        if render_template:
+            staging.render()
+        staging.close()
+    else:
+        # write the new template into the old excel sheet (and format the date and time columns), changing only the cells that differ
+        wb = load_workbook(template_file)
+        write_combined_data_to_sheet(final_data, wb[template_sheet])
+        wb.save(template_file)
+
+report.finish()
@@ -16,16 +16,183 @@ Users should create a yaml file that stores there ODMF credentials (url, usernam
 """
 
 import os
+import datetime
+import json
+import time
 import yaml
 from odmfclient import login
+import numpy as np
 import pandas as pd
-import re
+import pyarrow as pa
 from openpyxl import load_workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
 import logging
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from metadata_cache import MetadataCache, CachedAPI
+from value_cache import ValueCache
+from icasa_merge import upsert_rows
+from icasa_mapping import ICASAMapping, parse_ICASA_comment, request_valuetype
+from icasa_staging import sheet_to_frame, write_combined_data_to_sheet
+from pipeline import run_pipeline
+from run_report import RunReport, stage, frame_bytes, count
 
+
+def fetch_dataset(api, dataset_id, start_date, end_time, dataset_obj=None) -> tuple:
+    """
+    Downloads the values of a single dataset and, if there are any, the dataset object holding its metadata.
+
+    Parameters
+    ----------
+    api : ?
+        Odmfclient login with url, username and password.
+    dataset_id : integer
+        ID given in the ODMF system to the dataset.
+    start_date : string
+        First date for which data should be exported in format yyyy-mm-dd.
+    end_time : string
+        Last time stamp for which data should be exported (e.g. yyyy-mm-ddT23:59:59Z).
+    dataset_obj : dict, optional
+        Dataset object if it was already requested. The default is None.
+
+    Returns
+    -------
+    (data, dataset_obj) : tuple
+        Values of the dataset and the dataset object. dataset_obj is None if no values were found.
+
+    """
+    with stage("download") as record:
+        data = api.dataset.values_parquet(dsid=dataset_id, start=start_date, end=end_time)
+        record.update(rows_out=len(data), bytes_out=frame_bytes(data))
+    if data.empty:
+        return data, None
+    return data, dataset_obj if dataset_obj is not None else api.dataset(dsid=dataset_id)
+
+
+def fetch_datasets(api, dataset_ids, start_date, end_time, max_workers=1, timeout=None, start_dates=None, dataset_objs=None) -> list:
+    """
+    Downloads values and metadata of many datasets, optionally in parallel using a bounded thread pool.
+    The results are returned in the order of dataset_ids, so the outcome does not depend on max_workers.
+
+    Parameters
+    ----------
+    api : ?
+        Odmfclient login with url, username and password.
+    dataset_ids : list of integers
+        IDs of the datasets to download.
+    start_date : string
+        First date for which data should be exported in format yyyy-mm-dd.
+    end_time : string
+        Last time stamp for which data should be exported (e.g. yyyy-mm-ddT23:59:59Z).
+    max_workers : integer, optional
+        Number of datasets downloaded at the same time. The default is 1 (one after another, without threads unless a timeout is given).
+    timeout : float, optional
+        Seconds each download may take, counted from the start of its request. If a download takes longer, a TimeoutError is raised 
+        right away and the downloads that did not start yet are cancelled. The request itself cannot be interrupted and finishes in a background thread.
+        The default is None (wait forever).
+    start_dates : dict, optional
+        First date (yyyy-mm-dd) to download for single datasets (dataset_id as key), used instead of start_date. The default is None.
+    dataset_objs : dict, optional
+        Dataset objects that were already requested (dataset_id as key). The default is None.
+
+    Returns
+    -------
+    results : list of tuples
+        (dataset_id, data, dataset_obj) for each dataset, see fetch_dataset.
+
+    """
+    return list(iter_fetch_datasets(api, dataset_ids, start_date, end_time, max_workers, timeout, start_dates, dataset_objs))
+
+
+def iter_fetch_datasets(api, dataset_ids, start_date, end_time, max_workers=1, timeout=None, start_dates=None, dataset_objs=None):
+    """
+    Generator version of fetch_datasets: yields (dataset_id, data, dataset_obj) in the order of dataset_ids as soon as each download is done.
+    At most 2*max_workers downloads are started ahead of the consumer, so the memory used by waiting results stays bounded.
+    Closing the generator cancels the downloads that did not start yet. Dataset objects given in dataset_objs (dataset_id as key) are not requested again.
+    With a timeout, the downloads run in threads (also for max_workers=1) so that a download that takes too long can be abandoned (see fetch_datasets).
+    """
+    start_dates = start_dates or {}
+    dataset_objs = dataset_objs or {}
+    if timeout is None and (max_workers is None or max_workers <= 1):
+        for dataset_id in dataset_ids:
+            yield (dataset_id, *fetch_dataset(api, dataset_id, start_dates.get(dataset_id, start_date), end_time, dataset_objs.get(dataset_id)))
+        return
+    max_workers = max(1, max_workers or 1)
+
+    def timed_fetch(started, *args):
+        started.append(time.monotonic()) # the timeout counts from here, not from the submission
+        return fetch_dataset(api, *args)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = deque()
     
-def data_by_valuetype(api, valuetype_id, project_id, start_date, end_date) -> pd.DataFrame: 
+    def first_result():
+        dataset_id, future, started = futures.popleft()
+        while True:
+            if timeout is None or not started:
+                wait = timeout # the download did not start yet, check again later
+            else:
+                wait = max(0, started[0] + timeout - time.monotonic())
+            try:
+                return (dataset_id, *future.result(timeout=wait))
+            except FutureTimeoutError:
+                if started and time.monotonic() - started[0] >= timeout:
+                    raise TimeoutError(f"Download of dataset {dataset_id} took longer than {timeout} s") from None
+    
+    try:
+        for dataset_id in dataset_ids:
+            started = []
+            futures.append((dataset_id, executor.submit(timed_fetch, started, dataset_id, start_dates.get(dataset_id, start_date), end_time, dataset_objs.get(dataset_id)), started))
+            if len(futures) >= 2 * max_workers:
+                yield first_result()
+        while futures:
+            yield first_result()
+    finally:
+        # downloads waiting in the queue are cancelled, a download that timed out is not waited for
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def assemble_datasets(frames, labels) -> pd.DataFrame:
+    """
+    Concatenates the values of many datasets in one go and attaches one label per dataset (e.g. site and level)
+    as dictionary-encoded (categorical) columns. The frames are converted to Arrow tables that share one
+    dictionary per label, so the concatenation does not copy the data and the labels are stored as small integer codes.
+
+    Parameters
+    ----------
+    frames : list of pd.DataFrames
+        Values of the datasets as returned by values_parquet, all with the same columns.
+    labels : dict
+        Column name as key and a list with one value per frame (None if not set) as value.
+
+    Returns
+    -------
+    data_total : pd.DataFrame
+        All frames below each other with the label columns as categoricals.
+
+    """
+    dictionaries = {}
+    codes = {}
+    for col, values in labels.items():
+        categories = pd.Index(values, dtype=object).dropna().unique()
+        dictionaries[col] = pa.array(categories.tolist())
+        codes[col] = categories.get_indexer(pd.Index(values, dtype=object)) # -1 where the label is None
+        
+    tables = []
+    for i, frame in enumerate(frames):
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        for col in labels:
+            code = codes[col][i]
+            if code < 0:
+                indices = pa.nulls(len(frame), pa.int32())
+            else:
+                indices = pa.array(np.full(len(frame), code, dtype=np.int32))
+            table = table.append_column(col, pa.DictionaryArray.from_arrays(indices, dictionaries[col]))
+        tables.append(table)
+
+    return pa.concat_tables(tables).to_pandas()
+
+
+def data_by_valuetype(api, valuetype_id, project_id, start_date, end_date, max_workers=1, timeout=None, start_dates=None, compact=False) -> pd.DataFrame: 
     """
     Exports all data from a given ODMF database and a given project that stores 
     values of the given type, between the start date and the end date (included).
@@ -42,31 +209,181 @@ def data_by_valuetype(api, valuetype_id, project_id, start_date, end_date) -> pd
         First date for which data should be exported in format yyyy-mm-dd.
     end_date : string
         Last date for which data should be exported in format yyyy-mm-dd.
+    max_workers : integer, optional
+        Number of datasets downloaded at the same time. The default is 1.
+    timeout : float, optional
+        Seconds each download may take, counted from the start of its request (see fetch_datasets). The default is None (wait forever).
+    start_dates : dict, optional
+        Later first dates (yyyy-mm-dd) for single datasets (dataset_id as key), e.g. from ExportState.start_dates. The default is None.
+    compact : boolean or string, optional
+        True to return the data in the compact representation (see compact_values), "float32" to store the values 
+        as float32 in addition. The default is False (dates as datetime64, times as timedelta64 and values as float64).
 
     Returns
     -------
     data_total : pd.DataFrame
-        extracted data sorted by site, level, and time
+        extracted data sorted by site, level, and time (with the dataset_id of each value)
 
     """
     datasets = api.dataset.list(valuetype=valuetype_id, project=project_id)
-    data_total = pd.DataFrame(columns=["time", "value", "site", "level"])
     end_time = end_date+"T23:59:59Z"
-    for dataset_id in datasets:
-        data = api.dataset.values_parquet(dsid=dataset_id, start=start_date, end=end_time)
+    return combine_dataset_values(fetch_datasets(api, datasets, start_date, end_time, max_workers, timeout, start_dates), compact)
+
+
+def combine_dataset_values(results, compact=False) -> pd.DataFrame:
+    """
+    Combines the downloaded values of many datasets (as returned by fetch_datasets) into one DataFrame 
+    with the columns time (time of the day), value, site, level, dataset_id and date (compact: see compact_values).
+    """
+    frames = []
+    labels = {"site": [], "level": [], "dataset_id": []}
+    for dataset_id, data, dataset_obj in results:
         if not data.empty:
-            dataset_obj = api.dataset(dsid=dataset_id)
-            site = dataset_obj["site"]["id"]
-            data["site"]=site
-            level = dataset_obj["level"]
-            data["level"]=level
-            data_total = pd.concat([data_total, data], ignore_index = True)
-    data_total["date"]=data_total["time"].dt.normalize()
-    data_total["time"]=data_total["time"] - data_total["date"]
+            frames.append(data.astype({"value": np.float32}) if compact == "float32" else data)
+            labels["site"].append(dataset_obj["site"]["id"])
+            labels["level"].append(dataset_obj["level"])
+            labels["dataset_id"].append(dataset_id)
+    if not frames:
+        return pd.DataFrame({"time": pd.Series(dtype="timedelta64[ns]"), "value": pd.Series(dtype=float), "site": pd.Series(dtype=object), "level": pd.Series(dtype=object), "dataset_id": pd.Series(dtype=object), "date": pd.Series(dtype="datetime64[ns]")})
+    data_total = assemble_datasets(frames, labels)
+    if compact:
+        data_total["date"], data_total["time"] = split_time_stamps(data_total["time"])
+    else:
+        data_total["date"]=data_total["time"].dt.normalize()
+        data_total["time"]=data_total["time"] - data_total["date"]
     return data_total
 
 
-def data_by_site(api, site_id, project_id, start_date, end_date) -> dict:
+SECONDS_PER_DAY = 24*3600
+
+
+def split_time_stamps(times) -> tuple:
+    """
+    Splits time stamps into integer day codes (days since 1970-01-01) and the seconds of the day, both as int32
+    (compact representation of the columns date and time, see compact_values). Time zones are dropped keeping the local time.
+    """
+    if times.dt.tz is not None:
+        times = times.dt.tz_localize(None)
+    seconds = times.to_numpy(dtype="datetime64[s]").astype(np.int64)
+    days = seconds // SECONDS_PER_DAY
+    return days.astype(np.int32), (seconds - days*SECONDS_PER_DAY).astype(np.int32)
+
+
+def is_compact(data, date_col="date") -> bool:
+    """Returns True if the data is in the compact representation, i.e. the date column holds integer day codes."""
+    return date_col in data.columns and data[date_col].dtype.kind in "iu"
+
+
+def time_stamps(data) -> pd.Series:
+    """Returns the time stamps (date + time) of data exported by data_by_valuetype or data_by_site in either representation."""
+    if is_compact(data):
+        seconds = data["date"].to_numpy(dtype=np.int64)*SECONDS_PER_DAY + data["time"].to_numpy(dtype=np.int64)
+        return pd.Series(pd.to_datetime(seconds, unit="s"), index=data.index)
+    return data["date"] + data["time"]
+
+
+def day_codes(dates) -> np.ndarray:
+    """Returns the int32 day codes (days since 1970-01-01) of the given dates."""
+    return pd.DatetimeIndex(dates).normalize().to_numpy(dtype="datetime64[D]").astype(np.int32)
+
+
+def repeat_label(value, n) -> pd.Categorical:
+    """Returns a categorical of length n holding the given label (e.g. the level of a dataset) in every row, stored as int8 codes."""
+    if value is None:
+        return pd.Categorical.from_codes(np.full(n, -1, dtype=np.int8), categories=[])
+    return pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), categories=[value])
+
+
+def compact_values(data, float32=False) -> pd.DataFrame:
+    """
+    Converts data exported by data_by_valuetype or data_by_site to the compact representation, which needs several times less
+    memory for long exports of many sites: site, level and dataset_id as categoricals, date as int32 day codes (days since 1970-01-01),
+    time as int32 seconds of the day and, if float32 is True, the values as float32 (about 7 significant digits).
+    The export functions can produce this representation directly (compact=True), so the full-size columns are never created.
+    aggregate_data, derive_ICASA_variables and merge_new_data_to_ICASA accept both representations, the compact columns
+    are only expanded again by merge_new_data_to_ICASA (see expand_compact_values) before they are written to the template.
+    """
+    if is_compact(data):
+        compacted = data.copy()
+    else:
+        compacted = data.assign(time=time_stamps(data))
+        compacted["date"], compacted["time"] = split_time_stamps(compacted["time"])
+    for col in ["site", "level", "dataset_id"]:
+        if col in compacted.columns and not isinstance(compacted[col].dtype, pd.CategoricalDtype):
+            compacted[col] = compacted[col].astype("category")
+    if float32:
+        compacted["value"] = compacted["value"].astype(np.float32)
+    return compacted
+
+
+def expand_compact_values(data, date_col="date", time_col="time") -> pd.DataFrame:
+    """
+    Converts compact columns (see compact_values) back to the types written to Excel: day codes in date_col to dates,
+    seconds of the day in time_col to times and float32 columns to float64. float32 values are converted via their shortest 
+    decimal representation, so e.g. 0.1 is written as 0.1 and not as 0.10000000149. Other data is returned unchanged.
+    """
+    expanded = {}
+    if is_compact(data, date_col):
+        expanded[date_col] = pd.to_datetime(data[date_col].to_numpy(dtype=np.int64), unit="D")
+        if time_col in data.columns:
+            expanded[time_col] = pd.to_timedelta(data[time_col].to_numpy(dtype=np.int64), unit="s")
+    for col in data.columns:
+        if data[col].dtype == np.float32:
+            expanded[col] = data[col].astype(str).astype(np.float64).to_numpy()
+    if not expanded:
+        return data
+    return data.assign(**{str(col): values for col, values in expanded.items()})
+
+
+def bin_first_day(day, freq="D") -> pd.Timestamp:
+    '''Returns the first day of the time bin of the given pandas frequency (see aggregate_data) that contains the given day.'''
+    return pd.Timestamp(day).to_period(freq).start_time.normalize()
+
+
+def bin_last_day(day, freq="D") -> pd.Timestamp:
+    '''Returns the last day of the time bin of the given pandas frequency (see aggregate_data) that contains the given day.'''
+    return pd.Timestamp(day).to_period(freq).end_time.normalize()
+
+
+def data_by_valuetype_in_windows(api, valuetype_id, project_id, start_date, end_date, window_days=30, max_workers=1, timeout=None, start_dates=None, compact=False, agg_freq="D"):
+    """
+    Exports the same data as data_by_valuetype, but downloads it in consecutive time windows of whole days and yields 
+    one DataFrame per window, so only one window has to be kept in memory. Because the windows start and end at midnight 
+    and are extended to the end of the aggregation bin they end in, every bin lies completely within one window and 
+    aggregates (mean, min, max, sum, ...) of the windows are exact.
+
+    Parameters
+    ----------
+    api, valuetype_id, project_id, start_date, end_date, max_workers, timeout, start_dates, compact:
+        See data_by_valuetype.
+    window_days : integer, optional
+        Number of days downloaded at once (at least, the window is extended to the end of its last bin). The default is 30.
+    agg_freq : string, optional
+        Size of the time bins that are aggregated (see aggregate_data). The default is "D".
+
+    Yields
+    ------
+    data_window : pd.DataFrame
+        extracted data of one window sorted by site, level, and time (empty if there is no data in the window)
+
+    """
+    datasets = api.dataset.list(valuetype=valuetype_id, project=project_id)
+    dataset_objs = {} # dataset objects requested in earlier windows are not requested again
+    start_dates = start_dates or {}
+    window_start = pd.Timestamp(start_date)
+    last_day = pd.Timestamp(end_date)
+    while window_start <= last_day:
+        window_end = min(bin_last_day(window_start + pd.Timedelta(days=window_days-1), agg_freq), last_day)
+        first, last = window_start.strftime("%Y-%m-%d"), window_end.strftime("%Y-%m-%d")
+        window_datasets = [dataset_id for dataset_id in datasets if start_dates.get(dataset_id, first) <= last]
+        window_starts = {dataset_id: max(start_dates.get(dataset_id, first), first) for dataset_id in window_datasets}
+        results = fetch_datasets(api, window_datasets, first, last+"T23:59:59Z", max_workers, timeout, window_starts, dataset_objs)
+        dataset_objs.update({dataset_id: dataset_obj for dataset_id, data, dataset_obj in results if dataset_obj is not None})
+        yield combine_dataset_values(results, compact)
+        window_start = window_end + pd.Timedelta(days=1)
+
+
+def data_by_site(api, site_id, project_id, start_date, end_date, max_workers=1, timeout=None, start_dates=None, compact=False, dataset_objs=None) -> dict:
     '''
     Exports all data from a given site and a given project within ODMF database, between the start date and the end date (included),
     as one dataset per valuetype sorted in a dictionary.
@@ -83,6 +400,18 @@ def data_by_site(api, site_id, project_id, start_date, end_date) -> dict:
         First date for which data should be exported in format yyyy-mm-dd.
     end_date : string
         Last date for which data should be exported in format yyyy-mm-dd.
+    max_workers : integer, optional
+        Number of datasets downloaded at the same time. The default is 1.
+    timeout : float, optional
+        Seconds each download may take, counted from the start of its request (see fetch_datasets). The default is None (wait forever).
+    start_dates : dict, optional
+        Later first dates (yyyy-mm-dd) for single datasets (dataset_id as key), e.g. from ExportState.start_dates. The default is None.
+    compact : boolean or string, optional
+        True to return the data in the compact representation (see compact_values), "float32" to store the values 
+        as float32 in addition. The default is False.
+    dataset_objs : dict, optional
+        Dataset objects of the datasets to export (dataset_id as key), e.g. from select_mapped_datasets. 
+        The default is None (all datasets of the site are exported).
 
     Returns
     -------
@@ -90,25 +419,190 @@ def data_by_site(api, site_id, project_id, start_date, end_date) -> dict:
         Dictionary of pd.DataFrames for each dataset stored for the site.
 
     '''
-    datasets = api.dataset.list(site=site_id, project=project_id)
+    datasets = list(dataset_objs) if dataset_objs is not None else api.dataset.list(site=site_id, project=project_id)
     end_time = end_date+"T23:59:59Z"
     data_dict = {}
-    for dataset_id in datasets:
-        data = api.dataset.values_parquet(dsid=dataset_id, start=start_date, end=end_time)
+    for dataset_id, data, dataset_obj in fetch_datasets(api, datasets, start_date, end_time, max_workers, timeout, start_dates, dataset_objs):
         if not data.empty:
-            dataset_obj = api.dataset(dsid=dataset_id)
-            level = dataset_obj["level"]
-            data["level"]=level
             valuetype_id = dataset_obj["valuetype"]["id"]
-            data["date"]=data["time"].dt.normalize()
-            data["time"]=data["time"] - data["date"]
-            data_dict[valuetype_id] = data
+            data_dict[valuetype_id] = label_site_data(data, dataset_id, dataset_obj, compact)
     return data_dict
 
 
+def label_site_data(data, dataset_id, dataset_obj, compact=False) -> pd.DataFrame:
+    '''
+    Adds level and dataset_id of the dataset to its values and splits the time stamps into date and time (used by data_by_site).
+    With compact, the labels are stored as categoricals and date and time as integer codes (see compact_values).
+    '''
+    level = dataset_obj["level"]
+    if compact:
+        data["level"]=repeat_label(level, len(data))
+        data["dataset_id"]=repeat_label(dataset_id, len(data))
+        data["date"], data["time"] = split_time_stamps(data["time"])
+        if compact == "float32":
+            data["value"]=data["value"].astype(np.float32)
+        return data
+    data["level"]=level
+    data["dataset_id"]=dataset_id
+    data["date"]=data["time"].dt.normalize()
+    data["time"]=data["time"] - data["date"]
+    return data
+
+
+def iter_data_by_site(api, site_id, project_id, start_date, end_date, max_workers=1, timeout=None, start_dates=None, compact=False, dataset_objs=None):
+    '''
+    Generator version of data_by_site: yields (valuetype_id, data) as soon as all datasets of the valuetype are downloaded,
+    so that the data of the first valuetypes can be processed while the others are still downloading. 
+    The dataset objects of all datasets of the site are requested first (unless given), to know which datasets belong to which valuetype.
+    As in data_by_site, the data of the last dataset with values is used if a valuetype has several datasets at the site.
+    '''
+    if dataset_objs is None:
+        datasets = api.dataset.list(site=site_id, project=project_id)
+        dataset_objs = {dataset_id: api.dataset(dsid=dataset_id) for dataset_id in datasets}
+    datasets = list(dataset_objs)
+    end_time = end_date+"T23:59:59Z"
+    remaining = Counter(dataset_obj["valuetype"]["id"] for dataset_obj in dataset_objs.values())
+    latest = {}
+    for dataset_id, data, dataset_obj in iter_fetch_datasets(api, datasets, start_date, end_time, max_workers, timeout, start_dates, dataset_objs):
+        valuetype_id = dataset_objs[dataset_id]["valuetype"]["id"]
+        if not data.empty:
+            latest[valuetype_id] = label_site_data(data, dataset_id, dataset_obj, compact)
+        remaining[valuetype_id] -= 1
+        if remaining[valuetype_id] == 0 and valuetype_id in latest:
+            yield valuetype_id, latest.pop(valuetype_id)
+
+
+def select_mapped_datasets(api, site_id, project_id, workbook, mapping) -> dict:
+    '''
+    Returns the dataset objects (dataset_id as key) of the datasets of the site whose valuetype maps to at least one ICASA variable 
+    with a sheet in the template, so that only these are downloaded by data_by_site. Only the dataset objects are requested for this,
+    and if the project was built in the mapping (see ICASAMapping.build), only those of the selected datasets.
+    The skipped datasets are logged and counted in the run report (datasets_skipped).
+
+    Parameters
+    ----------
+    api, site_id, project_id:
+        See data_by_site.
+    workbook : ICASAWorkbook or ICASAStaging
+        Session on the ICASA template in which the sheets of the ICASA variables are looked up.
+    mapping : ICASAMapping
+        Registry of the ICASA variables of the valuetypes (see icasa_mapping.py).
+
+    Returns
+    -------
+    dataset_objs : dict
+        Dataset objects of the datasets to export.
+
+    '''
+    selected = {}
+    skipped = {} # valuetype -> (reason, number of datasets)
+    mapped_valuetypes = {}
+
+    def in_template(valuetype_id, valuetype_name, ICASA_infos) -> bool:
+        if valuetype_id not in mapped_valuetypes:
+            variable_names = [ICASA_info["Variable_name"] for ICASA_info in ICASA_infos]
+            found = []
+            for variable_name in variable_names:
+                try:
+                    workbook.find_sheet(variable_name)
+                    found.append(variable_name)
+                except ValueError:
+                    pass
+            mapped_valuetypes[valuetype_id] = bool(found)
+            if not found:
+                reason = f"{', '.join(variable_names)} not in the template" if variable_names else "no ICASA variable in the comment"
+                skipped[valuetype_id] = [valuetype_name or f"valuetype {valuetype_id}", reason, 0]
+        if not mapped_valuetypes[valuetype_id]:
+            skipped[valuetype_id][2] += 1
+        return mapped_valuetypes[valuetype_id]
+
+    if project_id is not None and mapping.built(project_id):
+        # the datasets and their valuetypes are stored, so only the dataset objects of the selected datasets are requested
+        datasets = mapping.datasets(project_id, site_id=site_id)
+        for dataset_id in datasets:
+            valuetype_id = mapping.valuetype_of_dataset(project_id, dataset_id)
+            if in_template(valuetype_id, mapping.valuetype_name(valuetype_id), mapping.variables(api, valuetype_id, project_id)):
+                selected[dataset_id] = api.dataset(dsid=dataset_id)
+    else:
+        datasets = api.dataset.list(site=site_id, project=project_id)
+        for dataset_id in datasets:
+            dataset_obj = api.dataset(dsid=dataset_id)
+            valuetype_obj = dataset_obj["valuetype"]
+            if in_template(valuetype_obj["id"], valuetype_obj.get("name"), mapping.variables_of_dataset(dataset_obj)):
+                selected[dataset_id] = dataset_obj
+    
+    n_skipped = len(datasets) - len(selected)
+    if n_skipped:
+        details = "; ".join(f"{name} ({reason}, {n} datasets)" for name, reason, n in skipped.values())
+        logging.info(f"{n_skipped} of {len(datasets)} datasets of site {site_id} are not downloaded, because they are not mapped to a sheet of the template: {details}")
+        count("datasets_skipped", n_skipped)
+    return selected
+
+
+SCALE_EQUIVARIANT_AGGREGATIONS = {"mean", "median", "sum", "min", "max", "first", "last", "std", "sem"} # agg(value/factor) == agg(value)/factor for positive factors
+COUNTING_AGGREGATIONS = {"count", "size", "nunique"} # not changed by a unit conversion
+
+
+def aggregate_data(df, aggregations, freq="D") -> pd.DataFrame:
+    """
+    Aggregates data exported from ODMF e.g. by data_by_valuetype per time bin, site and level, computing all given
+    aggregations of the column value in one grouping. Bins, sites and levels are converted to integer codes once and
+    combined into a single group code, so no string conversion of missing levels is needed (missing levels form their own group).
+    Data in the compact representation (see compact_values) is aggregated without expanding it and returned in the same representation.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        A dataframe containing values sorted by site, level and time (with the columns date, time, site, level and value).
+    aggregations : dict
+        Name of the output column as key and an aggregation function such as mean, sum, min, max as value.
+    freq : string, optional
+        Size of the time bins as pandas frequency, e.g. "h" (hourly), "D" (daily) or "W" (weekly, starting on Monday). The default is "D".
+
+    Returns
+    -------
+    data_summed : pd.DataFrame
+        DataFrame with the columns date (first day of the bin), site, level, time (mean time of the day) and one column per aggregation.
+
+    """
+    with stage("aggregate", rows_in=len(df), bytes_in=frame_bytes(df)) as record:
+        compact = is_compact(df)
+        if freq == "D":
+            bins = df["date"]
+        else:
+            bins = time_stamps(df).dt.to_period(freq).dt.start_time
+        
+        bin_codes, bin_values = pd.factorize(bins, sort=True)
+        site_codes, sites = pd.factorize(df["site"], sort=True, use_na_sentinel=False)
+        level_codes, levels = pd.factorize(df["level"], sort=True, use_na_sentinel=False)
+        group_codes = (bin_codes.astype(np.int64) * len(sites) + site_codes) * len(levels) + level_codes
+        
+        named_aggregations = {name: ("value", function_name) for name, function_name in aggregations.items()}
+        aggregated = df.groupby(group_codes, sort=True).agg(**named_aggregations, time=("time", "mean"))
+        
+        codes = aggregated.index.to_numpy()
+        bin_starts = bin_values.take(codes // (len(sites) * len(levels)))
+        if not compact:
+            dates = pd.DatetimeIndex(bin_starts).normalize()
+        elif freq == "D":
+            dates = bin_starts.to_numpy()
+        else:
+            dates = day_codes(bin_starts)
+        data_summed = pd.DataFrame({
+            "date": dates,
+            "site": sites.take(codes // len(levels) % len(sites)),
+            "level": levels.take(codes % len(levels)),
+        })
+        for name in aggregations:
+            data_summed[name] = aggregated[name].to_numpy()
+        data_summed["time"] = aggregated["time"].round().astype(np.int32).to_numpy() if compact else aggregated["time"].to_numpy()
+        record["rows_out"] = len(data_summed)
+    return data_summed
+
+
 def agg_data_daily(df, function_name) -> pd.DataFrame:
     """
-    Aggregates data exported from ODMF e.g. by data_by_valuetype per day using the given aggregation function.
+    Aggregates data exported from ODMF e.g. by data_by_valuetype per day using the given aggregation function (see aggregate_data).
 
     Parameters
     ----------
@@ -123,27 +617,88 @@ def agg_data_daily(df, function_name) -> pd.DataFrame:
         DataFrame containing the aggregated data.
 
     """
-    df["level"] = df["level"].fillna("None") #makes None a string to make grouping possible if there are no levels in the data
-    
-    data_summed = (
-    df
-    .groupby(
-        [
-            pd.Grouper(key='date', freq='D'),
-            'site',
-            'level'
-        ]
-    )                              
-    .agg(value=("value", function_name),time=("time", "mean"))                                    
-    .reset_index()                             
-    )
-    return data_summed
+    return aggregate_data(df, {"value": function_name}, "D")
+
+
+def convert_to_ICASA_variable(data, ICASA_info, freq="D") -> pd.DataFrame:
+    """
+    Derives the values of one ICASA variable from data exported from ODMF (e.g. by data_by_valuetype)
+    by applying the unit conversion and daily aggregation given in ICASA_info (as returned by extract_ICASA_info).
+    The given data is not changed, so several ICASA variables can be derived from the same export.
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        A dataframe containing values sorted by site, level and time.
+    ICASA_info : dict
+        Dictionary with the keys "Variable_name", "conversion" and "aggregation".
+    freq : string, optional
+        Size of the time bins for the aggregation (see aggregate_data). The default is "D".
+
+    Returns
+    -------
+    ICASA_data : pd.DataFrame
+        DataFrame with the converted (and aggregated) values in the column "value".
+
+    """
+    ICASA_conversion = ICASA_info["conversion"]
+    ICASA_aggregation = ICASA_info["aggregation"]
+    
+    ICASA_data = data
+    if ICASA_conversion != None:
+        ICASA_data = ICASA_data.assign(value=ICASA_data["value"]/ICASA_conversion)
+    
+    if ICASA_aggregation != None:
+        ICASA_data = aggregate_data(ICASA_data, {"value": ICASA_aggregation}, freq)
+    
+    return ICASA_data
+
+
+def derive_ICASA_variables(data, all_ICASA_infos, freq="D") -> list:
+    """
+    Derives the values of all given ICASA variables from the same data exported from ODMF (see convert_to_ICASA_variable).
+    All aggregations are computed together by aggregate_data, and variables that only differ in their unit conversion share 
+    one aggregate, which is divided by the conversion factor afterwards.
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        A dataframe containing values sorted by site, level and time.
+    all_ICASA_infos : list of dictionaries
+        As returned by extract_ICASA_info.
+    freq : string, optional
+        Size of the time bins for the aggregation (see aggregate_data). The default is "D".
+
+    Returns
+    -------
+    all_ICASA_data : list of pd.DataFrames
+        One DataFrame per ICASA variable with the converted (and aggregated) values in the column "value".
+
+    """
+    shared = {ICASA_info["aggregation"] for ICASA_info in all_ICASA_infos
+              if ICASA_info["aggregation"] in SCALE_EQUIVARIANT_AGGREGATIONS | COUNTING_AGGREGATIONS}
+    aggregated = aggregate_data(data, {function_name: function_name for function_name in shared}, freq) if shared else None
+    
+    all_ICASA_data = []
+    for ICASA_info in all_ICASA_infos:
+        ICASA_conversion = ICASA_info["conversion"]
+        ICASA_aggregation = ICASA_info["aggregation"]
+        if ICASA_aggregation in shared:
+            values = aggregated[ICASA_aggregation]
+            if ICASA_conversion != None and ICASA_aggregation not in COUNTING_AGGREGATIONS:
+                values = values/ICASA_conversion
+            ICASA_data = aggregated[["date", "site", "level", "time"]].assign(value=values)
+        else:
+            ICASA_data = convert_to_ICASA_variable(data, ICASA_info, freq)
+        all_ICASA_data.append(ICASA_data)
+    return all_ICASA_data
 
 
 def extract_ICASA_info (api, valuetype_id, project_id) -> list:
     '''
     Extracts information about the ICASA variable corresponding to the given value_type.
-    A list of all ICASA variables listed in the comment is returned.
+    A list of all ICASA variables listed in the comment is returned (see icasa_mapping.parse_ICASA_comment).
+    Use an ICASAMapping to look up many valuetypes without requesting and parsing their comments again.
 
     Parameters
     ----------
@@ -161,29 +716,12 @@ def extract_ICASA_info (api, valuetype_id, project_id) -> list:
         and the agrregation function for transform from the value_type to the ICASA variable_name for each ICASA variable_name that is given in the ODMF comment.
         
     '''
-    datasets = api.dataset.list(valuetype=valuetype_id, project=project_id)
-    first_dataset = datasets[1]
-    first_dataset_obj = api.dataset(dsid=first_dataset)
-    valuetype_info =first_dataset_obj["valuetype"]["comment"]
-   
-    pattern = re.compile(
-    r'''
-    ICASA:\s*
-    (?P<Variable_name>[^*\n,]+)          # Variable_name (mandatory)
-    (?:\*(?P<conversion>\d+(?:\.\d+)?))?   # *conversion (optional but required if * present)
-    (?:,\s*(?P<aggregation>\S+))?          # ,aggregation (optional but required if , present)
-    \s*$                        # line end
-    ''',
-    re.VERBOSE | re.MULTILINE
-    )
-   
-    all_info = []
-    
-    for extraction in pattern.finditer(valuetype_info):
-        ICASA_dict=extraction.groupdict()
-        factor = ICASA_dict.get("conversion")
-        ICASA_dict["conversion"]=float(factor) if factor else None
-        all_info.append(ICASA_dict)
+    valuetype_obj = request_valuetype(api, valuetype_id, project_id)
+    if valuetype_obj is None:
+        logging.warning(f"No dataset of valuetype {valuetype_id} found in project {project_id}, so its ICASA variables are unknown")
+        return []
+    
+    all_info = parse_ICASA_comment(valuetype_obj["comment"])
         
     return all_info
 
@@ -221,7 +759,8 @@ def find_ICASA_sheet_by_variable_name (variable_name, file_path) -> str:
 def merge_new_data_to_ICASA (new_data, template_data, site_col= "sampling_location_number", date_col = "date_of_measurement", time_col = "time_of_measurement", level_col = None, overwrite=False) -> pd.DataFrame:
     '''
     Merges data provided in the format as returned by the export functions (columns site, date, time, value and level)
-    into an ICASA template sheet. 
+    into an ICASA template sheet. Data in the compact representation (see compact_values) is expanded to the types 
+    of the template sheet here, after the columns not present in the template were dropped.
 
     Parameters
     ----------
@@ -243,29 +782,27 @@ def merge_new_data_to_ICASA (new_data, template_data, site_col= "sampling_locati
     Returns
     -------
     final_data: pd.DataFrame
-        templated_data into which common variables of new_data were merged.
+        templated_data into which common variables of new_data were merged (see icasa_merge.upsert_rows).
 
     '''
     common_cols = new_data.columns.intersection(template_data.columns)
 
-    new_data_subset = new_data.loc[:,common_cols]
+    new_data_subset = expand_compact_values(new_data.loc[:,common_cols], date_col, time_col)
     
     candidate_keys = [site_col, date_col, time_col, level_col]
 
     keys = [k for k in candidate_keys if k in common_cols]
     
+    for key in keys:
+        if isinstance(new_data_subset[key].dtype, pd.CategoricalDtype):
+            new_data_subset[key] = new_data_subset[key].astype(object) # categorical keys do not merge with the plain columns of the template
+    
     data_cols = [col for col in common_cols if col not in keys]
 
-    merged_data = pd.merge(template_data, new_data_subset, on = keys, how = 'outer', suffixes = ("_t", "_i"))
-
-    if overwrite:
-        for col in data_cols:
-            merged_data[col] = merged_data[f"{col}_i"].combine_first(merged_data[f"{col}_t"]) #creates combination columns that have the original names (stored in data_cols), containing value from new_data. Only if new_data has no value, use value from template_data.
-    else:
-        for col in data_cols:
-            merged_data[col] = merged_data[f"{col}_t"].combine_first(merged_data[f"{col}_i"]) #creates combination columns that have the original names (stored in data_cols), containing value from template_data. Only if template_data has no value, use value from new_data.
-
-    final_data = merged_data[template_data.columns] #drop colums that where created while merging and not needed after combining
+    with stage("merge", rows_in=len(new_data_subset)) as record:
+        final_data, inserted, updated = upsert_rows(template_data, new_data_subset, keys, data_cols, overwrite) #updates rows with matching keys in place and adds the others
+        record.update(rows_out=len(final_data), rows_inserted=inserted, rows_updated=updated)
+    logging.info(f"Merged {', '.join(data_cols)} into the template: {inserted} rows inserted, {updated} rows updated")
     
     return final_data
 
@@ -294,32 +831,214 @@ def write_combined_data_to_excel (combined_data, file_path, sheet_name, date_col
 
     '''
     wb = load_workbook(file_path)
-    ws = wb[sheet_name]
+    write_combined_data_to_sheet(combined_data, wb[sheet_name], date_col, time_col)
+    wb.save(file_path) 
+
+
+class ICASAWorkbook:
+    '''
+    Session on an ICASA template workbook: the file is loaded once, sheet lookups, reads and writes 
+    of all ICASA variables are served from memory and the file is saved a single time with save().
+    Sheets are read with the values last calculated by Excel for formula cells (as pd.read_excel), 
+    the formulas are kept in the workbook that is written.
+    
+    Parameters
+    ----------
+    file_path: string
+        Path to the ICASA template file into which the data should be pasted. This file will be partially overwritten so store a copy elsewhere to not risk of loosing data or the original template!
 
-    # Write new data starting at row 4
-    for r_idx, row in enumerate(dataframe_to_rows(combined_data, index=False, header=True), start=4):
-        for c_idx, value in enumerate(row, start=1):
-            ws.cell(row=r_idx, column=c_idx, value=value)
+    '''
+    
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with stage("load_workbook", bytes_in=os.path.getsize(file_path)):
+            self.workbook = load_workbook(file_path)
+        self._values = None # read-only view of the file with the calculated values of formula cells
+        self._variable_sheets = None
+        self.changed_sheets = set()
+        self.written_sheets = set()
+    
+    def _values_workbook(self):
+        if self._values is None:
+            self._values = load_workbook(self.file_path, read_only=True, data_only=True)
+        return self._values
+        
+    def find_sheet(self, variable_name) -> str:
+        '''
+        Returns the name of the data sheet in which the given ICASA variable name is listed in row 4 
+        (same as find_ICASA_sheet_by_variable_name). Raises a ValueError if the variable name is not found.
+        '''
+        if self._variable_sheets is None:
+            self._variable_sheets = {}
+            for sheet in self.workbook.sheetnames:
+                for value in next(self.workbook[sheet].iter_rows(min_row=4, max_row=4, values_only=True), ()):
+                    if value is not None:
+                        self._variable_sheets[str(value)] = sheet # the last sheet listing the variable is used
+        
+        if str(variable_name) not in self._variable_sheets:
+            raise ValueError("Variable name is not found in the provided ICASA template (check for spaces!)")
+        
+        return self._variable_sheets[str(variable_name)]
+    
+    def read_sheet(self, sheet_name) -> pd.DataFrame:
+        '''
+        Returns the data of the given sheet with the column names from row 4
+        (as pd.read_excel(file_path, sheet_name=sheet_name, skiprows=3), including data written in this session).
+        '''
+        with stage("read_sheet") as record:
+            if sheet_name in self.written_sheets:
+                sheet_data = sheet_to_frame(self.workbook[sheet_name])
+            else:
+                sheet_data = sheet_to_frame(self._values_workbook()[sheet_name])
+            record["rows_out"] = len(sheet_data)
+        return sheet_data
+    
+    def write_sheet(self, combined_data, sheet_name, date_col = "date_of_measurement", time_col = "time_of_measurement"):
+        '''
+        Writes the data to the given sheet in memory (see write_combined_data_to_sheet). The file is only changed by save().
+        '''
+        with stage("write_sheet", rows_in=len(combined_data)) as record:
+            cells_written = write_combined_data_to_sheet(combined_data, self.workbook[sheet_name], date_col, time_col)
+            record["cells_written"] = cells_written
+        logging.info(f"{cells_written} cells written to {sheet_name}")
+        if cells_written:
+            self.changed_sheets.add(sheet_name)
+        self.written_sheets.add(sheet_name) # read from the session from now on
+    
+    def save(self):
+        '''Saves the workbook to file_path if any sheet was written.'''
+        if self.changed_sheets:
+            if self._values is not None:
+                self._values.close() # the file is replaced
+                self._values = None
+            with stage("save_workbook") as record:
+                self.workbook.save(self.file_path)
+                record["bytes_out"] = os.path.getsize(self.file_path)
+            self.changed_sheets.clear()
 
-    # get headers
-    header = [cell.value for cell in ws[4]]
 
-    # date_of_measurement column formatting
-    if date_col in header:
-        date_col_idx = header.index(date_col) + 1  # 1-based indexing
-        for row in ws.iter_rows(min_row=5, min_col=date_col_idx, max_col=date_col_idx):
-            row[0].number_format = "yyyy-mm-dd"
+def ICASA_sheets(workbook, ICASA_infos) -> list:
+    '''Returns the names of the sheets of the workbook that hold the given ICASA variables (see extract_ICASA_info), each once.'''
+    sheet_names = []
+    for ICASA_info in ICASA_infos:
+        try:
+            sheet_name = workbook.find_sheet(ICASA_info["Variable_name"])
+        except ValueError:
+            continue
+        if sheet_name not in sheet_names:
+            sheet_names.append(sheet_name)
+    return sheet_names
 
-    # time_of_measurement column formatting
-    if time_col in header:
-        time_col_idx = header.index(time_col) + 1
-        for row in ws.iter_rows(min_row=5, min_col=time_col_idx, max_col=time_col_idx):
-            row[0].number_format = "hh:mm:ss"
 
-    wb.save(file_path) 
+class ExportState:
+    '''
+    Watermarks of an incremental export: the last exported time stamp per target sheet and dataset, stored in a small json file.
+    Use one state file per ICASA template. Delete the file (or an entry) to export the full date range again.
+    
+    Parameters
+    ----------
+    path: string
+        Path to the json file. It is created by save() if it does not exist.
+
+    '''
+    
+    def __init__(self, path):
+        self.path = path
+        self.watermarks = {} # sheet name -> {dataset_id: last exported time stamp (iso format)}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.watermarks = json.load(f)
+    
+    def start_dates(self, sheet_names=None, dataset_sheets=None) -> dict:
+        '''
+        Returns the first date (yyyy-mm-dd) to download for each dataset that already has a watermark in all sheets it is exported to:
+        the sheets given per dataset in dataset_sheets (dataset_id -> sheet names, e.g. in an export by site), else the given sheet_names 
+        (the same for all datasets, e.g. in an export by valuetype), else the sheets in which the dataset has a watermark. 
+        The earliest of these watermarks is used and its day is downloaded again, so that daily aggregates are computed from the complete day. 
+        Datasets without watermark in one of their sheets are not listed and are exported for the full date range.
+        '''
+        if dataset_sheets is None:
+            dataset_sheets = {}
+            for sheet, marks in self.watermarks.items():
+                if sheet_names is None or sheet in sheet_names:
+                    for dataset_id in marks:
+                        dataset_sheets.setdefault(int(dataset_id), []).append(sheet)
+            if sheet_names is not None:
+                dataset_sheets = {dataset_id: sheet_names for dataset_id in dataset_sheets}
+        starts = {}
+        for dataset_id, sheets in dataset_sheets.items():
+            marks = [self.watermarks.get(sheet, {}).get(str(dataset_id)) for sheet in sheets]
+            if marks and all(marks):
+                starts[int(dataset_id)] = min(marks)[:10]
+        return starts
+    
+    def update(self, sheet_name, last_times):
+        '''
+        Moves the watermarks of the given sheet forward to the given time stamps (pd.Series with the dataset_id as index).
+        '''
+        marks = self.watermarks.setdefault(sheet_name, {})
+        for dataset_id, last_time in last_times.items():
+            last_time = pd.Timestamp(last_time).isoformat()
+            if last_time > marks.get(str(dataset_id), ""):
+                marks[str(dataset_id)] = last_time
+    
+    def save(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.watermarks, f, indent=1)
+
+
+def last_times_by_dataset(data) -> pd.Series:
+    '''
+    Returns the time stamp of the last value of each dataset in data exported by data_by_valuetype or data_by_site.
+    '''
+    return time_stamps(data).groupby(data["dataset_id"], observed=True).max()
 
 
-def data_to_ICASA_by_valuetype (api, valuetype_id, project_id, start_date, end_date, file_path, site_col= "sampling_location_number", date_col = "date_of_measurement", time_col = "time_of_measurement",  level_col = None, overwrite =False):
+def merge_ICASA_variable_into_workbook (data, ICASA_name, workbook, site_col= "sampling_location_number", date_col = "date_of_measurement", time_col = "time_of_measurement", level_col = None, overwrite=False) -> bool:
+    '''
+    Finds the sheet of the given ICASA variable in the workbook session, merges the data into the data stored in the sheet and writes the result back to the sheet.
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        Data of the ICASA variable with columns already renamed to the ICASA column names.
+    ICASA_name : string
+        Name of the ICASA variable.
+    workbook : ICASAWorkbook or ICASAStaging
+        Session on the ICASA template or staging store of its sheets.
+    site_col, date_col, time_col, level_col, overwrite:
+        See data_to_ICASA_by_valuetype.
+
+    Returns
+    -------
+    written : string or None
+        Name of the sheet the data was written to, or None if the variable was skipped because no matching sheet or date column was found.
+
+    '''
+    try:
+        ICASA_sheet_name = workbook.find_sheet(ICASA_name)
+    except ValueError:
+        logging.warning(f"No sheet with the variable {ICASA_name} could be found in the template. Skipped {ICASA_name}")
+        return None
+    
+    template_data = workbook.read_sheet(ICASA_sheet_name)
+    
+    try:
+        template_data[date_col]=pd.to_datetime(template_data[date_col])
+    except:
+        logging.warning(f"there is no {date_col} in the same sheet as {ICASA_name}. Skipped {ICASA_name}")
+        return None
+    
+    if time_col in template_data.columns:
+        template_data[time_col]=pd.to_timedelta(template_data[time_col].map(lambda t: t.isoformat() if isinstance(t, datetime.time) else t)) # times formatted as hh:mm:ss are read as datetime.time
+    
+    combined_data = merge_new_data_to_ICASA(data, template_data, site_col, date_col, time_col, level_col, overwrite)
+    
+    workbook.write_sheet(combined_data, ICASA_sheet_name, date_col, time_col)
+    return ICASA_sheet_name
+
+
+def data_to_ICASA_by_valuetype (api, valuetype_id, project_id, start_date, end_date, file_path, site_col= "sampling_location_number", date_col = "date_of_measurement", time_col = "time_of_measurement",  level_col = None, overwrite =False, max_workers=1, timeout=None, workbook=None, state=None, window_days=None, agg_freq="D", compact=False, mapping=None):
     '''
     Extracts data from the ODMF system for the given valuetype and project (all sites), 
     converts it to the format of the given ICASA template and writes into the given ICASA file.
@@ -349,55 +1068,89 @@ def data_to_ICASA_by_valuetype (api, valuetype_id, project_id, start_date, end_d
         Name of the column in the ICASA template into which ODMF layer information should be pasted (e.g. me_soil_layer_bot_depth). The default is None.
     overwrite: boolean, optional
         Switch to allow overwriting existing values in the ICASA template with new data. The default is False.
+    max_workers : integer, optional
+        Number of datasets downloaded from ODMF at the same time. The default is 1.
+    timeout : float, optional
+        Seconds each download may take, counted from the start of its request (see fetch_datasets). The default is None (wait forever).
+    workbook : ICASAWorkbook or ICASAStaging, optional
+        Session on the ICASA template (or staging store of its sheets, see icasa_staging.py) shared by several exports. The caller has to call workbook.save() in this case.
+        The default is None (the template at file_path is loaded and saved once by this function).
+    state : ExportState, optional
+        Watermarks for an incremental export: datasets are only downloaded from the first day of the aggregation bin (agg_freq) of their last exported value onward and 
+        the watermarks are moved forward for the sheets written. The state is saved together with the workbook (by the caller if workbook is given).
+        Use overwrite=True to replace aggregates of the last bin that was incomplete in the previous run. The default is None (full export).
+    window_days : integer, optional
+        Download and aggregate the data in time windows of this number of days (see data_by_valuetype_in_windows) to limit the memory needed for long time spans. 
+        Only ICASA variables with an aggregation profit from this. The default is None (all data at once).
+    agg_freq : string, optional
+        Size of the time bins used for the aggregation given in the ODMF comment as pandas frequency, e.g. "h" (hourly), "D" (daily) or "W" (weekly). The default is "D".
+    compact : boolean or string, optional
+        Keep the exported data in the compact representation (see compact_values) until it is merged into the template, which cuts 
+        the memory needed for long exports of many sites several-fold. "float32" stores the values as float32 in addition (about 7 significant digits).
+        Times of the day are rounded to full seconds. The default is False.
+    mapping : ICASAMapping, optional
+        Registry of the ICASA variables of the valuetypes (see icasa_mapping.py), so the comment of the valuetype is not requested again. 
+        The default is None (the comment is requested with extract_ICASA_info).
     Returns
     -------
     None.
 
     '''
-    all_ICASA_infos = extract_ICASA_info(api, valuetype_id, project_id)
+    if mapping is not None:
+        all_ICASA_infos = mapping.variables(api, valuetype_id, project_id)
+    else:
+        all_ICASA_infos = extract_ICASA_info(api, valuetype_id, project_id)
     
-    for ICASA_info in all_ICASA_infos:
+    own_workbook = workbook is None
+    if own_workbook:
+        workbook = ICASAWorkbook(file_path)
+    
+    target_sheets = ICASA_sheets(workbook, all_ICASA_infos)
+    if not target_sheets: # nothing to download
+        logging.warning(f"None of the ICASA variables of valuetype {valuetype_id} ({', '.join(ICASA_info['Variable_name'] for ICASA_info in all_ICASA_infos) or 'none in the comment'}) has a sheet in the template. Skipped valuetype {valuetype_id}")
+        return
+    
+    start_dates = None
+    if state is not None:
+        start_dates = {dataset_id: max(bin_first_day(day, agg_freq).strftime("%Y-%m-%d"), start_date) for dataset_id, day in state.start_dates(target_sheets).items()}
+    
+    if window_days is None:
+        raw_windows = [data_by_valuetype(api, valuetype_id, project_id, start_date, end_date, max_workers, timeout, start_dates, compact)]
+    else:
+        raw_windows = data_by_valuetype_in_windows(api, valuetype_id, project_id, start_date, end_date, window_days, max_workers, timeout, start_dates, compact, agg_freq)
+    
+    ICASA_parts = [[] for ICASA_info in all_ICASA_infos]
+    last_times = []
+    for raw_data in raw_windows: # downloaded once for all ICASA variables of the valuetype
+        if raw_data.empty:
+            continue
+        for parts, ICASA_data in zip(ICASA_parts, derive_ICASA_variables(raw_data, all_ICASA_infos, agg_freq)):
+            parts.append(ICASA_data)
+        last_times.append(last_times_by_dataset(raw_data))
+    
+    for parts, ICASA_info in zip(ICASA_parts, all_ICASA_infos):
         ICASA_name = ICASA_info["Variable_name"]
-        ICASA_conversion = ICASA_info["conversion"]
-        ICASA_aggregation = ICASA_info["aggregation"]
-        
-        data = data_by_valuetype(api, valuetype_id, project_id, start_date, end_date)
         
-        if data.empty:
+        if not parts:
             logging.warning(f"No dataset could be exported for {ICASA_name}. Check whether (1) Datasets are present for the given site and you have access to them via the project and api provided, (2) the datsets have entries in the time span you provided, and (3) you are connected to a network that gives you access to ODMF.")
             continue
         
-        if ICASA_conversion != None:
-           data["value"] = data["value"]/ICASA_conversion
-        
-        if ICASA_aggregation != None:
-            data = agg_data_daily(data, ICASA_aggregation)
+        data = parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
          
         data = data.rename(columns={"date": date_col, "time": time_col, "site": site_col, "level": level_col, "value": ICASA_name})
             
-        try:
-            ICASA_sheet_name = find_ICASA_sheet_by_variable_name(ICASA_name, file_path)
-        except:
-            logging.waring(f"No sheet with the variable {ICASA_name} could be found in the template. Skipped {ICASA_name}")
-            continue
-        
-        template_data = pd.read_excel(file_path, sheet_name=ICASA_sheet_name, skiprows=3)
-        
-        try:
-            template_data[date_col]=pd.to_datetime(template_data[date_col])
-        except:
-            logging.warning(f"there is no {date_col} in the same sheet as {ICASA_name}. Skipped {ICASA_name}")
-            continue
+        ICASA_sheet_name = merge_ICASA_variable_into_workbook(data, ICASA_name, workbook, site_col, date_col, time_col, level_col, overwrite)
         
-        if time_col in template_data.columns:
-            template_data[time_col]=pd.to_timedelta(template_data[time_col])
-        
-        combined_data = merge_new_data_to_ICASA(data, template_data, site_col, date_col, time_col, level_col, overwrite)
-            
-        write_combined_data_to_excel(combined_data, file_path, ICASA_sheet_name, date_col, time_col)
+        if state is not None and ICASA_sheet_name is not None:
+            state.update(ICASA_sheet_name, pd.concat(last_times).groupby(level=0, observed=True).max())
+    
+    if own_workbook:
+        workbook.save()
+        if state is not None:
+            state.save()
 
 
-def data_to_ICASA_by_site (api, site_id, project_id, start_date, end_date, file_path, site_col= "weather_station_id", date_col = "date_of_measurement", time_col = "time_of_measurement",  level_col = None, overwrite =False):
+def data_to_ICASA_by_site (api, site_id, project_id, start_date, end_date, file_path, site_col= "weather_station_id", date_col = "date_of_measurement", time_col = "time_of_measurement",  level_col = None, overwrite =False, max_workers=1, timeout=None, workbook=None, state=None, agg_freq="D", pipeline=False, queue_size=2, compact=False, mapping=None):
     '''
     Extracts data from the ODMF system for the given site and project (all valuetypes), 
     converts it to the format of the given ICASA template and writes into the given ICASA file.
@@ -427,79 +1180,138 @@ def data_to_ICASA_by_site (api, site_id, project_id, start_date, end_date, file_
         Name of the column in the ICASA template into which ODMF layer information should be pasted (e.g. me_soil_layer_bot_depth). The default is None.
     overwrite: boolean, optional
         Switch to allow overwriting existing values in the ICASA template with new data. The default is False.
+    max_workers : integer, optional
+        Number of datasets downloaded from ODMF at the same time. The default is 1.
+    timeout : float, optional
+        Seconds each download may take, counted from the start of its request (see fetch_datasets). The default is None (wait forever).
+    workbook : ICASAWorkbook or ICASAStaging, optional
+        Session on the ICASA template (or staging store of its sheets, see icasa_staging.py) shared by several exports. The caller has to call workbook.save() in this case.
+        The default is None (the template at file_path is loaded and saved once by this function).
+    state : ExportState, optional
+        Watermarks for an incremental export: datasets are only downloaded from the first day of the aggregation bin (agg_freq) of their last exported value onward and 
+        the watermarks are moved forward for the sheets written. The state is saved together with the workbook (by the caller if workbook is given).
+        Use overwrite=True to replace aggregates of the last bin that was incomplete in the previous run. The default is None (full export).
+    agg_freq : string, optional
+        Size of the time bins used for the aggregation given in the ODMF comment as pandas frequency, e.g. "h" (hourly), "D" (daily) or "W" (weekly). The default is "D".
+    pipeline : boolean, optional
+        Switch to download, aggregate and write in separate stages that run at the same time (see pipeline.py): valuetypes are 
+        aggregated as soon as their datasets are downloaded and written while the next ones are processed. The default is False.
+    queue_size : integer, optional
+        Number of valuetypes (downloaded) or ICASA variables (aggregated) that may wait for the next stage in pipeline mode. The default is 2.
+    compact : boolean or string, optional
+        Keep the exported data in the compact representation (see compact_values and data_to_ICASA_by_valuetype). The default is False.
+    mapping : ICASAMapping, optional
+        Registry of the ICASA variables of the valuetypes (see icasa_mapping.py). The default is None (a registry for this export only,
+        filled with the comments of the valuetypes requested).
     Returns
     -------
     None.
 
     '''
 
-    data_dict = data_by_site(api, site_id, project_id, start_date, end_date)
+    if mapping is None:
+        mapping = ICASAMapping()
     
-    for valuetype_id in data_dict:
-        all_ICASA_infos = extract_ICASA_info(api, valuetype_id, project_id)
-        
-        for ICASA_info in all_ICASA_infos:
-            ICASA_name = ICASA_info["Variable_name"]
-            ICASA_conversion = ICASA_info["conversion"]
-            ICASA_aggregation = ICASA_info["aggregation"]
-                
-            data = data_dict[valuetype_id]
-            data["site"] = site_id
-                
-            if data.empty:
-                logging.warning(f"No dataset could be exported for {ICASA_name}. Check whether (1) Datasets are present for the given site and you have access to them via the project and api provided, (2) the datsets have entries in the time span you provided, and (3) you are connected to a network that gives you access to ODMF.")
-                continue
-                
-            if ICASA_conversion != None:
-                data["value"] = data["value"]/ICASA_conversion
-                
-            if ICASA_aggregation != None:
-                data = agg_data_daily(data, ICASA_aggregation)
-                 
-            data = data.rename(columns={"date": date_col, "time": time_col, "site": site_col, "level": level_col, "value": ICASA_name})
-                    
-            try:
-                ICASA_sheet_name = find_ICASA_sheet_by_variable_name(ICASA_name, file_path)
-            except:
-                logging.warning(f"No sheet with the variable {ICASA_name} could be found in the template. Skipped {ICASA_name}")
-                continue
-                
-            template_data = pd.read_excel(file_path, sheet_name=ICASA_sheet_name, skiprows=3)
-                
-            try:
-                template_data[date_col]=pd.to_datetime(template_data[date_col])
-            except:
-                logging.warning(f"there is no {date_col} in the same sheet as {ICASA_name}. Skipped {ICASA_name}")
-                continue
-            
-            if time_col in template_data.columns:
-                template_data[time_col]=pd.to_timedelta(template_data[time_col])
+    own_workbook = workbook is None
+    if own_workbook:
+        workbook = ICASAWorkbook(file_path)
+    
+    dataset_objs = select_mapped_datasets(api, site_id, project_id, workbook, mapping) # unmapped datasets are not downloaded
+    
+    start_dates = None
+    if state is not None:
+        dataset_sheets = {dataset_id: ICASA_sheets(workbook, mapping.variables_of_dataset(dataset_obj)) for dataset_id, dataset_obj in dataset_objs.items()}
+        start_dates = {dataset_id: max(bin_first_day(day, agg_freq).strftime("%Y-%m-%d"), start_date) for dataset_id, day in state.start_dates(dataset_sheets=dataset_sheets).items()}
+    
+    if pipeline:
+        ICASA_parts = run_pipeline(iter_data_by_site(api, site_id, project_id, start_date, end_date, max_workers, timeout, start_dates, compact, dataset_objs),
+                                   lambda valuetype_data: derive_site_ICASA_variables(api, valuetype_data, site_id, project_id, agg_freq, compact, mapping),
+                                   queue_size=queue_size) # downloads and aggregation run in background threads while the workbook is written
+    else:
+        data_dict = data_by_site(api, site_id, project_id, start_date, end_date, max_workers, timeout, start_dates, compact, dataset_objs)
+        ICASA_parts = derive_site_ICASA_variables(api, data_dict.items(), site_id, project_id, agg_freq, compact, mapping)
+    
+    for ICASA_name, data, last_times in ICASA_parts:
+        data = data.rename(columns={"date": date_col, "time": time_col, "site": site_col, "level": level_col, "value": ICASA_name})
                 
-            combined_data = merge_new_data_to_ICASA(data, template_data, site_col, date_col, time_col, level_col, overwrite)
-                    
-            write_combined_data_to_excel(combined_data, file_path, ICASA_sheet_name, date_col, time_col)   
+        ICASA_sheet_name = merge_ICASA_variable_into_workbook(data, ICASA_name, workbook, site_col, date_col, time_col, level_col, overwrite)
+        
+        if state is not None and ICASA_sheet_name is not None:
+            state.update(ICASA_sheet_name, last_times)
+    
+    if own_workbook:
+        workbook.save()
+        if state is not None:
+            state.save()
 
 
-if __name__ == "__main__":
-    project_dir = os.path.abspath(os.path.dirname(__file__))
-    data_dir = os.path.join(project_dir, "../ODMF")
-    
-    config_path = os.path.join(data_dir, "config.yaml")
+def derive_site_ICASA_variables(api, valuetype_data, site_id, project_id, agg_freq="D", compact=False, mapping=None):
+    '''
+    Generator yielding (ICASA_name, data, last_times) for each ICASA variable of the given (valuetype_id, data) pairs
+    of a site (see data_by_site), with data converted and aggregated as given in the ODMF comment of the valuetype
+    (looked up in the mapping if given) and the last exported time stamp per dataset (see last_times_by_dataset).
+    '''
+    for valuetype_id, raw_data in valuetype_data:
+        if mapping is not None:
+            all_ICASA_infos = mapping.variables(api, valuetype_id, project_id)
+        else:
+            all_ICASA_infos = extract_ICASA_info(api, valuetype_id, project_id)
+        
+        raw_data["site"] = repeat_label(site_id, len(raw_data)) if compact else site_id
+        
+        all_ICASA_data = derive_ICASA_variables(raw_data, all_ICASA_infos, agg_freq)
+        last_times = last_times_by_dataset(raw_data)
+        
+        for ICASA_info, data in zip(all_ICASA_infos, all_ICASA_data):
+            yield ICASA_info["Variable_name"], data, last_times
+
+
+def load_odmf_config(config_path) -> tuple:
+    '''
+    Reads the ODMF credentials from the given yaml file (keys url, username and password, either at the top level or nested under odmf).
+
+    Returns
+    -------
+    (url, username, password) : tuple
+
+    '''
     with open(config_path, "r", encoding="utf-8") as cf:
         cfg = yaml.safe_load(cf)
 
     odmf_cfg = cfg.get("odmf", cfg)  # allow either top-level keys or nested under 'odmf'
 
-    url = odmf_cfg["url"]
-    username = odmf_cfg["username"]
-    password = odmf_cfg["password"]
+    return odmf_cfg["url"], odmf_cfg["username"], odmf_cfg["password"]
+
+
+if __name__ == "__main__":
+    project_dir = os.path.abspath(os.path.dirname(__file__))
+    data_dir = os.path.join(project_dir, "../ODMF")
+    
+    config_path = os.path.join(data_dir, "config.yaml")
+    url, username, password = load_odmf_config(config_path)
 
     template_file = "ICASA_for_agroforstry_input_test.xlsx"
     input_path = os.path.join(data_dir, template_file)
     
-    with login(url, username, password) as api:
+    metadata_cache = MetadataCache(path=os.path.join(data_dir, "odmf_metadata_cache.sqlite"), ttl=7*24*3600) # call metadata_cache.invalidate() after changing datasets in ODMF
+    
+    value_cache = ValueCache(os.path.join(data_dir, "odmf_value_cache"), max_bytes=2*1024**3) # use refresh=True to download cached values again
+    
+    mapping = ICASAMapping(os.path.join(data_dir, "icasa_mapping.json"), ttl=7*24*3600) # ICASA variables of the valuetypes, use build(..., refresh=True) after changing comments in ODMF
+    
+    with RunReport("export_ODMF", os.path.join(data_dir, "export_ODMF_report.json")) as report: # use profile=True for a cProfile dump next to the report
+        with login(url, username, password) as odmf_api:
+            api = CachedAPI(report.count_calls(odmf_api), metadata_cache, value_cache) # counts the requests that are not served by the caches
         
-        # FORMULA project id: 7
+            # FORMULA project id: 7
+            mapping.build(api, project_id=7)
+    
+            ICASA_test_output = data_to_ICASA_by_valuetype(api, valuetype_id=10, project_id=7, start_date="2025-10-18", end_date="2025-10-20", file_path=input_path, level_col = "me_soil_layer_top_depth", mapping=mapping)
+            #ICASA_weather_test_output = data_to_ICASA_by_site(api, site_id=3817, project_id=None, start_date="2026-02-19", end_date="2026-02-26", file_path=input_path, date_col = "weather_date", mapping=mapping)
+            mapping.save()
+            # to accumulate the data of many runs without writing the template each time, pass an ICASAStaging store as workbook (see icasa_staging.py)
     
-        ICASA_test_output = data_to_ICASA_by_valuetype(api, valuetype_id=10, project_id=7, start_date="2025-10-18", end_date="2025-10-20", file_path=input_path, level_col = "me_soil_layer_top_depth")
-        #ICASA_weather_test_output = data_to_ICASA_by_site(api, site_id=3817, project_id=None, start_date="2026-02-19", end_date="2026-02-26", file_path=input_path, date_col = "weather_date")
\ No newline at end of file
+        logging.info(f"ODMF metadata cache: {metadata_cache.stats}")
+        logging.info(f"ODMF value cache: {value_cache.stats}")
+        report.info.update(metadata_cache=metadata_cache.stats, value_cache=value_cache.stats)
+    metadata_cache.close()
\ No newline at end of file
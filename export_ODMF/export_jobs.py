@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Runs a batch of exports from ODMF into ICASA templates described in a yaml job file, instead of editing
+the calls in the main block of export_ODMF.py for every export.
+
+All jobs share one login and the metadata and value caches, so datasets needed by several jobs are only listed
+and downloaded once (overlapping time spans included). The ICASA variables of all valuetypes of the projects of the jobs
+are read in one pass before the first job (see ICASAMapping). The jobs are grouped by template: each template is loaded
+once, all its sheets are written in memory and it is saved a single time after its last job.
+
+Example job file (paths are relative to the job file):
+
+    config: config.yaml                 # ODMF credentials, see export_ODMF.load_odmf_config (default: config.yaml)
+    report: export_jobs_report.json     # optional, json report of the run (see run_report.py)
+    cache:                              # optional, see metadata_cache.py and value_cache.py
+      metadata: odmf_metadata_cache.sqlite
+      ttl: 604800
+      values: odmf_value_cache
+      max_bytes: 2147483648
+    mapping: icasa_mapping.json         # optional, ICASA variables of the valuetypes (see icasa_mapping.py)
+    defaults:                           # used for every job unless the job sets the key itself
+      project_id: 7
+      start_date: "2025-10-18"
+      end_date: "2025-10-20"
+      max_workers: 4
+    jobs:
+      - template: ICASA_for_agroforstry_input_test.xlsx
+        valuetype_id: 10
+        level_col: me_soil_layer_top_depth
+      - template: ICASA_for_agroforstry_input_test.xlsx
+        site_id: 3817
+        project_id: null
+        date_col: weather_date
+        state: export_state.json        # optional, incremental export (see ExportState)
+
+Each job needs a template and either a valuetype_id (data_to_ICASA_by_valuetype) or a site_id (data_to_ICASA_by_site),
+all other keys are passed to these functions.
+
+Run it with: python export_jobs.py path/to/export_jobs.yaml
+"""
+
+import inspect
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import yaml
+from odmfclient import login
+
+from export_ODMF import data_to_ICASA_by_valuetype, data_to_ICASA_by_site, load_odmf_config, ICASAWorkbook, ExportState
+from icasa_mapping import ICASAMapping
+from metadata_cache import MetadataCache, CachedAPI
+from run_report import RunReport
+from value_cache import ValueCache
+
+
+RUNNER_KEYS = {"template", "state"} # job keys used by the runner itself, all others are passed to the export functions
+
+
+def load_job_spec(path) -> dict:
+    '''Reads the yaml job file.'''
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f) or {}
+
+
+def expand_jobs(spec) -> list:
+    '''
+    Returns the jobs of the job file with the defaults filled in and duplicate jobs removed.
+    Raises a ValueError for jobs without template, with both or none of valuetype_id and site_id, or with unknown keys.
+    '''
+    defaults = spec.get("defaults") or {}
+    jobs = []
+    seen = set()
+    for number, job in enumerate(spec.get("jobs") or [], start=1):
+        job = {**defaults, **job}
+        if "template" not in job:
+            raise ValueError(f"Job {number} has no template")
+        if ("valuetype_id" in job) == ("site_id" in job):
+            raise ValueError(f"Job {number} needs either a valuetype_id or a site_id")
+        export_function = data_to_ICASA_by_valuetype if "valuetype_id" in job else data_to_ICASA_by_site
+        arguments = set(inspect.signature(export_function).parameters) - {"api", "file_path", "workbook", "state", "mapping"}
+        unknown = set(job) - RUNNER_KEYS - arguments
+        if unknown:
+            raise ValueError(f"Job {number} has unknown keys: {sorted(unknown)}")
+
+        key = json.dumps(job, sort_keys=True, default=str)
+        if key in seen:
+            logging.warning(f"Job {number} is a duplicate of an earlier job and is skipped")
+            continue
+        seen.add(key)
+        jobs.append(job)
+    return jobs
+
+
+def run_jobs(api, jobs, base_dir=".", mapping=None):
+    '''
+    Runs the given jobs (see expand_jobs) grouped by template with one workbook session per template,
+    which is saved once after its last job together with the export states of its jobs.
+
+    Parameters
+    ----------
+    api : ?
+        Odmfclient login, preferably wrapped in a CachedAPI with a value cache so that datasets are only downloaded once.
+    jobs : list of dicts
+        Jobs with template, valuetype_id or site_id and further arguments of the export functions.
+    base_dir : string, optional
+        Folder to which the paths of templates and states are relative. The default is the working directory.
+    mapping : ICASAMapping, optional
+        Registry of the ICASA variables of the valuetypes shared by all jobs. The default is None (a new one, built for the projects of the jobs).
+
+    Returns
+    -------
+    None.
+
+    '''
+    if mapping is None:
+        mapping = ICASAMapping()
+    for project_id in {job.get("project_id") for job in jobs} - {None}:
+        mapping.build(api, project_id)
+    
+    jobs_by_template = {}
+    for job in jobs:
+        jobs_by_template.setdefault(os.path.join(base_dir, job["template"]), []).append(job)
+
+    states = {}
+    for template_path, template_jobs in jobs_by_template.items():
+        workbook = ICASAWorkbook(template_path)
+        used_states = set()
+        for job in template_jobs:
+            state = None
+            if job.get("state") is not None:
+                state_path = os.path.join(base_dir, job["state"])
+                state = states.setdefault(state_path, ExportState(state_path))
+                used_states.add(state_path)
+            arguments = {key: value for key, value in job.items() if key not in RUNNER_KEYS}
+            if "valuetype_id" in job:
+                logging.info(f"Exporting valuetype {job['valuetype_id']} into {template_path}")
+                data_to_ICASA_by_valuetype(api, file_path=template_path, workbook=workbook, state=state, mapping=mapping, **arguments)
+            else:
+                logging.info(f"Exporting site {job['site_id']} into {template_path}")
+                data_to_ICASA_by_site(api, file_path=template_path, workbook=workbook, state=state, mapping=mapping, **arguments)
+
+        workbook.save()
+        for state_path in used_states:
+            states[state_path].save()
+        logging.info(f"{len(template_jobs)} jobs written to {template_path}")
+
+
+def run_job_file(path):
+    '''
+    Logs in to ODMF with the credentials given in the job file and runs all its jobs with shared caches.
+    Without a value cache in the job file, downloaded values are kept in a temporary folder for the duration of the run.
+    '''
+    spec = load_job_spec(path)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    jobs = expand_jobs(spec)
+
+    url, username, password = load_odmf_config(os.path.join(base_dir, spec.get("config", "config.yaml")))
+
+    cache_cfg = spec.get("cache") or {}
+    metadata_path = cache_cfg.get("metadata")
+    metadata_cache = MetadataCache(path=os.path.join(base_dir, metadata_path) if metadata_path else None, ttl=cache_cfg.get("ttl"))
+
+    report_path = os.path.join(base_dir, spec["report"]) if spec.get("report") else None
+    mapping = ICASAMapping(os.path.join(base_dir, spec["mapping"]) if spec.get("mapping") else None, ttl=cache_cfg.get("ttl"))
+
+    with tempfile.TemporaryDirectory() as temporary_dir, RunReport("export_jobs", report_path) as report:
+        if cache_cfg.get("values"):
+            value_cache = ValueCache(os.path.join(base_dir, cache_cfg["values"]), max_bytes=cache_cfg.get("max_bytes"))
+        else:
+            value_cache = ValueCache(temporary_dir, settle_time=0) # only shares downloads between the jobs of this run
+
+        with login(url, username, password) as odmf_api:
+            api = CachedAPI(report.count_calls(odmf_api), metadata_cache, value_cache)
+            run_jobs(api, jobs, base_dir, mapping)
+        mapping.save()
+
+        logging.info(f"ODMF metadata cache: {metadata_cache.stats}")
+        logging.info(f"ODMF value cache: {value_cache.stats}")
+        report.info.update(jobs=len(jobs), metadata_cache=metadata_cache.stats, value_cache=value_cache.stats)
+    metadata_cache.close()
+
+
+if __name__ == "__main__":
+    project_dir = os.path.abspath(os.path.dirname(__file__))
+    data_dir = os.path.join(project_dir, "../ODMF")
+
+    job_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(data_dir, "export_jobs.yaml")
+    run_job_file(job_file)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the ICASA variables of the ODMF valuetypes, read from the valuetype comments.
+
+Each valuetype lists its ICASA variables in its comment, one per line, as "ICASA: name*factor, aggregation"
+(factor and aggregation are optional). Instead of requesting and parsing the comment again for every export, the registry
+collects the comments of all valuetypes used in a project in one pass over the datasets of the project, parses them once
+and stores the resulting table (valuetype -> ICASA variables, dataset -> valuetype, site and level) in a small json file.
+Exports then look up the ICASA variables of a valuetype without any request, and can plan which datasets they need
+before downloading data.
+
+    with login(url, username, password) as api:
+        api = CachedAPI(api, metadata_cache)
+        mapping = ICASAMapping("icasa_mapping.json", ttl=7*24*3600).build(api, project_id=7)
+        data_to_ICASA_by_valuetype(api, ..., mapping=mapping)
+        mapping.save()
+
+Valuetypes that are not in the table (e.g. exports of a site without project) are requested when they are first used.
+Call build(api, project_id, refresh=True) or delete the file after changing comments or datasets in ODMF.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+ICASA_PATTERN = re.compile(
+    r'''
+    ICASA:\s*
+    (?P<Variable_name>[^*\n,]+)          # Variable_name (mandatory)
+    (?:\*(?P<conversion>\d+(?:\.\d+)?))?   # *conversion (optional but required if * present)
+    (?:,\s*(?P<aggregation>\S+))?          # ,aggregation (optional but required if , present)
+    \s*$                        # line end
+    ''',
+    re.VERBOSE | re.MULTILINE
+)
+
+
+def parse_ICASA_comment(comment) -> list:
+    '''
+    Returns the ICASA variables listed in the comment of a valuetype as dictionaries with the keys
+    Variable_name, conversion (float or None) and aggregation (string or None).
+    '''
+    all_info = []
+    for extraction in ICASA_PATTERN.finditer(comment or ""):
+        ICASA_dict = extraction.groupdict()
+        factor = ICASA_dict.get("conversion")
+        ICASA_dict["conversion"] = float(factor) if factor else None
+        all_info.append(ICASA_dict)
+    return all_info
+
+
+def request_valuetype(api, valuetype_id, project_id=None):
+    '''
+    Requests the valuetype object (id, name and comment) through the first dataset of the valuetype in the project,
+    or returns None if the project has no dataset of the valuetype.
+    '''
+    datasets = api.dataset.list(valuetype=valuetype_id, project=project_id)
+    if not datasets:
+        return None
+    return api.dataset(dsid=datasets[0])["valuetype"]
+
+
+class ICASAMapping:
+    '''
+    Table of the ICASA variables of each valuetype and of the valuetype, site and level of each dataset of the projects built.
+
+    Parameters
+    ----------
+    path : string, optional
+        Path of the json file in which the table is stored. It is read if it exists and written by save(). The default is None (memory only).
+    ttl : float, optional
+        Seconds after which a project or valuetype is requested again. The default is None (entries do not expire).
+
+    '''
+
+    def __init__(self, path=None, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.projects = {} # project id (string) -> {"built_at": time, "datasets": {dataset id (string): {"valuetype", "site", "level"}}}
+        self.valuetypes = {} # valuetype id (string) -> {"stored_at": time, "name", "comment", "variables": list of dictionaries}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                table = json.load(f)
+            self.projects = table.get("projects", {})
+            self.valuetypes = table.get("valuetypes", {})
+
+    def _expired(self, stored_at) -> bool:
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def add_valuetype(self, valuetype_obj):
+        '''Parses the comment of the given valuetype object (as found in a dataset object) and stores its ICASA variables.'''
+        with self._lock:
+            self.valuetypes[str(valuetype_obj["id"])] = {
+                "stored_at": time.time(),
+                "name": valuetype_obj.get("name"),
+                "comment": valuetype_obj.get("comment"),
+                "variables": parse_ICASA_comment(valuetype_obj.get("comment")),
+            }
+
+    def build(self, api, project_id, max_workers=1, refresh=False):
+        '''
+        Requests the dataset objects of all datasets of the project (in parallel with max_workers) and stores the
+        ICASA variables of their valuetypes and the valuetype, site and level of each dataset.
+        A project that was built before is only requested again if it expired or refresh is True. Returns the registry.
+        '''
+        if self.built(project_id) and not refresh:
+            return self
+
+        dataset_ids = api.dataset.list(project=project_id)
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            dataset_objs = list(executor.map(lambda dataset_id: api.dataset(dsid=dataset_id), dataset_ids))
+
+        datasets = {}
+        seen_valuetypes = set()
+        for dataset_id, dataset_obj in zip(dataset_ids, dataset_objs):
+            valuetype_obj = dataset_obj["valuetype"]
+            datasets[str(dataset_id)] = {"valuetype": valuetype_obj["id"], "site": dataset_obj["site"]["id"], "level": dataset_obj["level"]}
+            if valuetype_obj["id"] not in seen_valuetypes:
+                seen_valuetypes.add(valuetype_obj["id"])
+                self.add_valuetype(valuetype_obj)
+        with self._lock:
+            self.projects[str(project_id)] = {"built_at": time.time(), "datasets": datasets}
+        logging.info(f"ICASA mapping of project {project_id}: {len(datasets)} datasets of {len(seen_valuetypes)} valuetypes")
+        return self
+
+    def variables(self, api, valuetype_id, project_id=None) -> list:
+        '''
+        Returns the ICASA variables of the valuetype (as extract_ICASA_info). Valuetypes that are not stored yet
+        are requested through a dataset of the given project and added to the table.
+        '''
+        entry = self.valuetypes.get(str(valuetype_id))
+        if entry is None or self._expired(entry["stored_at"]):
+            valuetype_obj = request_valuetype(api, valuetype_id, project_id)
+            if valuetype_obj is None:
+                logging.warning(f"No dataset of valuetype {valuetype_id} found in project {project_id}, so its ICASA variables are unknown")
+                return []
+            self.add_valuetype(valuetype_obj)
+            entry = self.valuetypes[str(valuetype_id)]
+        return entry["variables"]
+
+    def variables_of_dataset(self, dataset_obj) -> list:
+        '''
+        Returns the ICASA variables of the valuetype of the given dataset object without any request
+        (the comment of the valuetype is only parsed if the valuetype is not stored yet or expired).
+        '''
+        valuetype_obj = dataset_obj["valuetype"]
+        entry = self.valuetypes.get(str(valuetype_obj["id"]))
+        if entry is None or self._expired(entry["stored_at"]):
+            self.add_valuetype(valuetype_obj)
+            entry = self.valuetypes[str(valuetype_obj["id"])]
+        return entry["variables"]
+
+    def built(self, project_id) -> bool:
+        '''Returns True if the datasets of the project are stored and not expired.'''
+        project = self.projects.get(str(project_id))
+        return project is not None and not self._expired(project["built_at"])
+
+    def valuetype_of_dataset(self, project_id, dataset_id):
+        '''Returns the valuetype id of a dataset of a built project. Raises a KeyError if the project was not built.'''
+        return self.projects[str(project_id)]["datasets"][str(dataset_id)]["valuetype"]
+
+    def valuetype_name(self, valuetype_id):
+        '''Returns the stored name of the valuetype, or None.'''
+        return self.valuetypes.get(str(valuetype_id), {}).get("name")
+
+    def datasets(self, project_id, valuetype_id=None, site_id=None) -> list:
+        '''
+        Returns the ids of the datasets of a built project, optionally only those of the given valuetype and/or site.
+        Raises a KeyError if the project was not built.
+        '''
+        return [int(dataset_id) for dataset_id, info in self.projects[str(project_id)]["datasets"].items()
+                if (valuetype_id is None or info["valuetype"] == valuetype_id) and (site_id is None or info["site"] == site_id)]
+
+    def save(self):
+        '''Writes the table to path (if given).'''
+        if self.path is None:
+            return
+        with self._lock:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump({"projects": self.projects, "valuetypes": self.valuetypes}, f, indent=1)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Merge engine used to add new data to the data of an ICASA template sheet (export_ODMF.py and data_transform.py).
+
+The template rows are indexed once on the key columns (e.g. site, date, time and level or treatment_number, date and RP),
+rows of the new data with a matching key update the template row in place and all other rows are inserted.
+For unique keys the result is the same as the full outer merge followed by combine_first per column that was used before.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+
+def sort_by_keys(data, keys) -> pd.DataFrame:
+    '''
+    Sorts the rows by the key columns like an outer pd.merge does (numbers before strings, 
+    missing dates and times first and other missing keys last).
+    '''
+    codes = []
+    for key in keys:
+        key_codes, uniques = pd.factorize(data[key], sort=True)
+        missing_code = -1 if data[key].dtype.kind in "mM" else len(uniques) # pd.merge sorts NaT by its integer value
+        codes.append(np.where(key_codes < 0, missing_code, key_codes))
+    order = np.lexsort(codes[::-1])
+    return data.iloc[order].reset_index(drop=True)
+
+
+def upsert_rows(template_data, new_data, keys, data_cols, overwrite=False, sort=True) -> tuple:
+    '''
+    Updates and inserts the rows of new_data into template_data using the key columns.
+
+    Parameters
+    ----------
+    template_data : pd.DataFrame
+        Data of the template sheet.
+    new_data : pd.DataFrame
+        New data, containing the key columns and the data columns.
+    keys : list of strings
+        Columns identifying a row in both frames.
+    data_cols : list of strings
+        Columns of new_data that should be merged into template_data.
+    overwrite : boolean, optional
+        Switch to allow overwriting existing values in template_data with values of new_data. Values missing in new_data never
+        remove values of template_data. The default is False (only empty cells of template_data are filled).
+    sort : boolean, optional
+        Switch to sort the result by the keys, as the outer merge did. The default is True.
+
+    Returns
+    -------
+    (final_data, inserted, updated) : tuple
+        final_data has the columns of template_data, inserted is the number of new rows,
+        updated the number of existing rows in which at least one value changed.
+
+    '''
+    if template_data[keys].duplicated().any() or new_data[keys].duplicated().any():
+        logging.info("Keys are not unique, merging with an outer join instead of updating rows in place")
+        return outer_merge_rows(template_data, new_data, keys, data_cols, overwrite)
+
+    positions = pd.MultiIndex.from_frame(template_data[keys]).get_indexer(pd.MultiIndex.from_frame(new_data[keys]))
+    matched = positions >= 0
+
+    final_data = template_data.reset_index(drop=True) # new frame, template_data is not changed
+    updated = 0
+    if data_cols and matched.any():
+        old_values = final_data.loc[positions[matched], data_cols]
+        new_values = new_data.loc[matched, data_cols].set_axis(old_values.index)
+        if overwrite:
+            combined = new_values.where(new_values.notna(), old_values)
+        else:
+            combined = old_values.where(old_values.notna(), new_values)
+        changed = combined.ne(old_values) & ~(combined.isna() & old_values.isna())
+        updated = int(changed.any(axis=1).sum())
+        if updated:
+            for col in data_cols:
+                col_changed = changed[col].reindex(final_data.index, fill_value=False)
+                if col_changed.any():
+                    final_data[col] = final_data[col].mask(col_changed, combined[col].reindex(final_data.index))
+
+    inserted = int((~matched).sum())
+    if inserted:
+        new_rows = new_data.loc[~matched, [*keys, *data_cols]].reindex(columns=final_data.columns)
+        if final_data.empty:
+            final_data = new_rows.reset_index(drop=True)
+        else:
+            empty_cols = {col: final_data[col].dtype for col in final_data.columns if new_rows[col].isna().all() and final_data[col].dtype.kind in "fOMm"}
+            final_data = pd.concat([final_data, new_rows.astype(empty_cols)], ignore_index=True) # empty columns get the dtype of the template
+
+    if sort:
+        final_data = sort_by_keys(final_data, keys)
+    return final_data, inserted, updated
+
+
+def outer_merge_rows(template_data, new_data, keys, data_cols, overwrite=False) -> tuple:
+    '''
+    Merges new_data into template_data with a full outer merge and combine_first per data column
+    (used by upsert_rows if the keys are not unique). Returns the same tuple as upsert_rows.
+    '''
+    merged_data = pd.merge(template_data, new_data[[*keys, *data_cols]], on = keys, how = 'outer', suffixes = ("_t", "_i"), indicator = True)
+
+    if overwrite:
+        for col in data_cols:
+            merged_data[col] = merged_data[f"{col}_i"].combine_first(merged_data[f"{col}_t"]) #creates combination columns that have the original names (stored in data_cols), containing value from new_data. Only if new_data has no value, use value from template_data.
+    else:
+        for col in data_cols:
+            merged_data[col] = merged_data[f"{col}_t"].combine_first(merged_data[f"{col}_i"]) #creates combination columns that have the original names (stored in data_cols), containing value from template_data. Only if template_data has no value, use value from new_data.
+
+    inserted = int((merged_data["_merge"] == "right_only").sum())
+    updated = int((merged_data["_merge"] == "both").sum())
+    return merged_data[template_data.columns], inserted, updated
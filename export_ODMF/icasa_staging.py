@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Staging store for the data sheets of an ICASA template (used by export_ODMF.py and data_transform.py).
+
+Instead of parsing and saving the Excel template on every run, the merged data of each sheet is kept in a columnar
+store (one Parquet file per sheet in a folder, or one table per sheet in a SQLite file). Runs read and write the
+staged data, which is cheap, and render() writes all staged sheets into the Excel template in a single pass
+when the template is actually needed.
+
+    staging = ICASAStaging(template_file, "ICASA_staging")               # or backend="sqlite" with a .sqlite path
+    data_to_ICASA_by_valuetype(api, ..., file_path=template_file, workbook=staging)
+    staging.save()
+    ...
+    staging.render()                                                      # or staging.render("ICASA_for_delivery.xlsx")
+
+A sheet is read from the template the first time it is used and from the staging store afterwards. Changes made
+to a staged sheet directly in the Excel file are therefore not seen; delete the staged sheet (or the whole store)
+to read the sheet from the template again.
+
+The module only depends on pandas, pyarrow and openpyxl.
+"""
+
+import datetime
+import json
+import logging
+import os
+import sqlite3
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import load_workbook
+from openpyxl.utils.dataframe import dataframe_to_rows
+
+from run_report import stage
+
+
+def sheet_to_frame(ws) -> pd.DataFrame:
+    '''
+    Returns the data of the given openpyxl worksheet with the column names from row 4
+    (as pd.read_excel(file_path, sheet_name=sheet_name, skiprows=3)).
+    '''
+    rows = ws.iter_rows(min_row=4, values_only=True)
+    header = list(next(rows, ()))
+    data = [list(row) for row in rows if any(value is not None for value in row)] # empty rows are skipped as in pd.read_excel
+    data = [row + [None] * (len(header) - len(row)) for row in data] # rows of read-only sheets end with their last value
+
+    while header and header[-1] is None and all(row[len(header)-1] is None for row in data): # drop empty columns at the end of the sheet
+        header.pop()
+    data = [row[:len(header)] for row in data]
+    columns = [name if name is not None else f"Unnamed: {i}" for i, name in enumerate(header)]
+
+    sheet_data = pd.DataFrame(data, columns=columns)
+    empty_cols = [col for col in sheet_data.columns if sheet_data[col].isna().all()]
+    return sheet_data.astype({col: float for col in empty_cols}) # empty columns are read as float by pd.read_excel
+
+
+def same_cell_value(old_value, new_value) -> bool:
+    '''
+    Checks whether a value already stored in a cell equals the value that should be written
+    (empty cells equal None/NaN/NaT, times read as datetime.time equal timedeltas up to a millisecond).
+    '''
+    old_empty = old_value is None or (not isinstance(old_value, str) and pd.isna(old_value))
+    new_empty = new_value is None or (not isinstance(new_value, str) and pd.isna(new_value))
+    if old_empty or new_empty:
+        return old_empty and new_empty
+    if isinstance(old_value, datetime.time) and isinstance(new_value, datetime.timedelta):
+        old_value = datetime.timedelta(hours=old_value.hour, minutes=old_value.minute, seconds=old_value.second, microseconds=old_value.microsecond)
+        return abs(old_value - new_value) < datetime.timedelta(milliseconds=1)
+    if type(old_value) is str or type(new_value) is str:
+        return type(old_value) is type(new_value) and old_value == new_value
+    try:
+        return bool(old_value == new_value)
+    except (TypeError, ValueError):
+        return False
+
+
+def write_combined_data_to_sheet (combined_data, ws, date_col = "date_of_measurement", time_col = "time_of_measurement") -> int:
+    '''
+    Writes data in the format the ICASA template (as returned by merge_data_to_ICASA)
+    to the given openpyxl worksheet of an ICASA template, starting with the column names in row 4.
+    Only cells whose value differs from the value already stored in the sheet are written (and formatted),
+    rows below the last used row of the sheet are appended in bulk.
+
+    Parameters
+    ----------
+    combined_data : dataframe
+        Dataframe containing data from ODMF merged with the existing template data.
+    ws : openpyxl worksheet
+        Sheet within the ICASA template into which the data should be pasted.
+    date_col: string, optional
+        Name of the column in the ICASA template into which ODMF date information should be pasted (e.g. weather_date). The default is date_of_measurement.
+    time_col: string, optional
+        Name of the column in the ICASA template into which time split from ODMF data information should be pasted. The default is time_of_measurement.
+
+    Returns
+    -------
+    cells_written : integer
+        Number of cells that were changed or appended.
+
+    '''
+    header = list(combined_data.columns)
+    number_formats = {}
+    if date_col in header:
+        number_formats[header.index(date_col) + 1] = "yyyy-mm-dd"  # 1-based indexing
+    if time_col in header:
+        number_formats[header.index(time_col) + 1] = "hh:mm:ss"
+
+    last_row = ws.max_row
+    existing_rows = list(ws.iter_rows(min_row=4, max_row=last_row, values_only=True)) if last_row >= 4 else []
+    cells_written = 0
+
+    # Write new data starting at row 4
+    for r_idx, row in enumerate(dataframe_to_rows(combined_data, index=False, header=True), start=4):
+        if r_idx <= last_row:
+            existing_row = existing_rows[r_idx-4]
+            for c_idx, value in enumerate(row, start=1):
+                existing_value = existing_row[c_idx-1] if c_idx <= len(existing_row) else None
+                if not same_cell_value(existing_value, value):
+                    cell = ws.cell(row=r_idx, column=c_idx, value=value)
+                    if r_idx >= 5 and c_idx in number_formats:
+                        cell.number_format = number_formats[c_idx]
+                    cells_written += 1
+        else:
+            ws.append(row) # bulk path for new rows at the end of the sheet
+            if r_idx >= 5:
+                for c_idx, number_format in number_formats.items():
+                    ws.cell(row=r_idx, column=c_idx).number_format = number_format
+            cells_written += len(row)
+
+    return cells_written
+
+
+class ParquetStore:
+    '''Stores each sheet as <directory>/<sheet name>.parquet and the catalog as <directory>/catalog.json.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._catalog_path = os.path.join(directory, "catalog.json")
+
+    def _file(self, sheet_name) -> str:
+        return os.path.join(self.directory, f"{sheet_name}.parquet")
+
+    def load_catalog(self) -> dict:
+        if not os.path.exists(self._catalog_path):
+            return {}
+        with open(self._catalog_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_catalog(self, catalog):
+        with open(self._catalog_path, "w", encoding="utf-8") as f:
+            json.dump(catalog, f, indent=1)
+
+    def read(self, sheet_name, dtypes) -> pd.DataFrame:
+        return pd.read_parquet(self._file(sheet_name))
+
+    def write(self, sheet_name, data):
+        mixed_cols = []
+        for col in data.columns:
+            if data[col].dtype == object:
+                try:
+                    pa.array(data[col], from_pandas=True)
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    mixed_cols.append(col)
+        if mixed_cols:
+            logging.warning(f"Columns with mixed types in {sheet_name} are staged as text: {mixed_cols}")
+            data = data.copy()
+            for col in mixed_cols:
+                data[col] = data[col].map(lambda value: value if value is None or (not isinstance(value, str) and pd.isna(value)) else str(value))
+        pq.write_table(pa.Table.from_pandas(data, preserve_index=False), self._file(sheet_name))
+
+    def remove(self, sheet_name):
+        if os.path.exists(self._file(sheet_name)):
+            os.remove(self._file(sheet_name))
+
+    def close(self):
+        pass
+
+
+class SQLiteStore:
+    '''Stores each sheet as a table of a SQLite file and the catalog in the table _catalog.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS _catalog (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+
+    def load_catalog(self) -> dict:
+        row = self._db.execute("SELECT value FROM _catalog WHERE key = 'catalog'").fetchone()
+        return json.loads(row[0]) if row is not None else {}
+
+    def save_catalog(self, catalog):
+        self._db.execute("INSERT OR REPLACE INTO _catalog VALUES ('catalog', ?)", (json.dumps(catalog),))
+        self._db.commit()
+
+    def read(self, sheet_name, dtypes) -> pd.DataFrame:
+        data = pd.read_sql(f'SELECT * FROM "{sheet_name}"', self._db)
+        for col, dtype in dtypes.items(): # SQLite does not know dates and durations, restore the dtypes of the staged frame
+            if dtype.startswith("datetime64"):
+                data[col] = pd.to_datetime(data[col])
+            elif dtype.startswith("timedelta64"):
+                data[col] = pd.to_timedelta(data[col], unit="ns")
+            elif dtype != "object" and dtype != str(data[col].dtype):
+                data[col] = data[col].astype(dtype)
+        return data
+
+    def write(self, sheet_name, data):
+        data = data.copy()
+        for col in data.columns:
+            if data[col].dtype.kind == "m":
+                data[col] = data[col].astype("int64").astype(object).where(data[col].notna(), None) # durations are stored as nanoseconds
+        data.to_sql(sheet_name, self._db, if_exists="replace", index=False)
+        self._db.commit()
+
+    def remove(self, sheet_name):
+        self._db.execute(f'DROP TABLE IF EXISTS "{sheet_name}"')
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+class ICASAStaging:
+    '''
+    Staging store for the data sheets of an ICASA template with the same interface as ICASAWorkbook in export_ODMF.py
+    (find_sheet, read_sheet, write_sheet and save), so it can be passed as workbook to the export functions.
+
+    Parameters
+    ----------
+    template_path: string
+        Path to the ICASA template file. It is only read, except by render().
+    path: string
+        Folder of the Parquet files (backend "parquet") or path of the SQLite file (backend "sqlite"). It is created if it does not exist.
+    backend: string, optional
+        "parquet" or "sqlite". The default is "parquet".
+
+    '''
+
+    def __init__(self, template_path, path, backend="parquet"):
+        if backend == "parquet":
+            self.store = ParquetStore(path)
+        elif backend == "sqlite":
+            self.store = SQLiteStore(path)
+        else:
+            raise ValueError(f"Unknown staging backend {backend}, use 'parquet' or 'sqlite'")
+        self.template_path = template_path
+        self.catalog = self.store.load_catalog()
+        self.catalog.setdefault("headers", {}) # sheet name -> column names in row 4 of the template
+        self.catalog.setdefault("sheets", {})  # staged sheet name -> date and time column and dtypes
+        self.changed_sheets = set()
+        self._data = {}
+        self._template = None
+
+    def _template_workbook(self):
+        if self._template is None:
+            self._template = load_workbook(self.template_path, read_only=True, data_only=True) # calculated values of formula cells, as pd.read_excel
+        return self._template
+
+    def _close_template(self):
+        if self._template is not None:
+            self._template.close()
+            self._template = None
+
+    def find_sheet(self, variable_name) -> str:
+        '''
+        Returns the name of the data sheet in which the given ICASA variable name is listed in row 4 of the template.
+        Raises a ValueError if the variable name is not found.
+        '''
+        if not self.catalog["headers"]:
+            workbook = self._template_workbook()
+            for sheet in workbook.sheetnames:
+                self.catalog["headers"][sheet] = [str(value) for value in next(workbook[sheet].iter_rows(min_row=4, max_row=4, values_only=True), ()) if value is not None]
+
+        found = [sheet for sheet, header in self.catalog["headers"].items() if str(variable_name) in header]
+        if not found:
+            raise ValueError("Variable name is not found in the provided ICASA template (check for spaces!)")
+
+        return found[-1] # the last sheet listing the variable is used, as in ICASAWorkbook
+
+    def read_sheet(self, sheet_name) -> pd.DataFrame:
+        '''
+        Returns the staged data of the given sheet, or the data of the template sheet if the sheet was not staged yet.
+        '''
+        if sheet_name not in self._data:
+            if sheet_name in self.catalog["sheets"]:
+                self._data[sheet_name] = self.store.read(sheet_name, self.catalog["sheets"][sheet_name]["dtypes"])
+            else:
+                self._data[sheet_name] = sheet_to_frame(self._template_workbook()[sheet_name])
+        return self._data[sheet_name].copy()
+
+    def write_sheet(self, combined_data, sheet_name, date_col = "date_of_measurement", time_col = "time_of_measurement"):
+        '''
+        Stages the data of the given sheet in memory. The store is only changed by save(), the template only by render().
+        '''
+        self._data[sheet_name] = combined_data.reset_index(drop=True)
+        self.catalog["sheets"][sheet_name] = {"date_col": date_col, "time_col": time_col, "dtypes": {str(col): str(dtype) for col, dtype in combined_data.dtypes.items()}}
+        self.changed_sheets.add(sheet_name)
+
+    def save(self):
+        '''Writes the changed sheets and the catalog to the staging store.'''
+        with stage("save_staging") as record:
+            for sheet_name in self.changed_sheets:
+                self.store.write(sheet_name, self._data[sheet_name])
+                record["rows_out"] = record.get("rows_out", 0) + len(self._data[sheet_name])
+            self.store.save_catalog(self.catalog)
+        self.changed_sheets.clear()
+        self._close_template()
+
+    def discard(self, sheet_name=None):
+        '''Removes the given sheet, or all sheets if no sheet_name is given, from the store, so they are read from the template again.'''
+        for staged_sheet in ([sheet_name] if sheet_name is not None else list(self.catalog["sheets"])):
+            self.store.remove(staged_sheet)
+            self.catalog["sheets"].pop(staged_sheet, None)
+            self._data.pop(staged_sheet, None)
+            self.changed_sheets.discard(staged_sheet)
+        self.store.save_catalog(self.catalog)
+
+    def render(self, file_path=None) -> int:
+        '''
+        Writes all staged sheets into the ICASA template in one pass and saves it to file_path
+        (the default is the template itself, which is partially overwritten).
+
+        Returns
+        -------
+        cells_written : integer
+            Number of cells that were changed or appended in the template.
+
+        '''
+        self._close_template()
+        with stage("render_workbook") as record:
+            workbook = load_workbook(self.template_path)
+            cells_written = 0
+            for sheet_name, info in self.catalog["sheets"].items():
+                cells_written += write_combined_data_to_sheet(self.read_sheet(sheet_name), workbook[sheet_name], info["date_col"], info["time_col"])
+            workbook.save(file_path if file_path is not None else self.template_path)
+            record["cells_written"] = cells_written
+        logging.info(f"{cells_written} cells written while rendering {len(self.catalog['sheets'])} staged sheets")
+        return cells_written
+
+    def close(self):
+        self._close_template()
+        self.store.close()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Cache for metadata requested from the ODMF database (dataset listings and dataset objects,
+which hold the site, level and valuetype information of each dataset).
+
+The cache keeps recently used entries in memory (least recently used entries are dropped first)
+and can additionally store them in a small SQLite file, so that exports on the next day do not have
+to request the same metadata again. Entries older than the given time to live are requested again.
+
+Use it by wrapping the odmfclient login:
+
+    with login(url, username, password) as api:
+        api = CachedAPI(api, MetadataCache(path="odmf_metadata.sqlite", ttl=24*3600))
+        data_to_ICASA_by_valuetype(api, ...)
+        print(api.cache.stats)
+
+Values (api.dataset.values_parquet) are passed through to ODMF, unless a ValueCache (value_cache.py) is given.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MetadataCache:
+    '''
+    In-memory LRU cache with an optional on-disk store and time to live.
+
+    Parameters
+    ----------
+    maxsize : integer, optional
+        Maximum number of entries kept in memory. The default is 1024.
+    path : string, optional
+        Path to a SQLite file in which the entries are stored on disk. The default is None (memory only).
+    ttl : float, optional
+        Time to live of an entry in seconds. The default is None (entries do not expire).
+
+    '''
+
+    def __init__(self, maxsize=1024, path=None, ttl=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict() # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, stored_at REAL, value TEXT)")
+            self._db.commit()
+
+    @property
+    def stats(self) -> dict:
+        '''Counters of cache hits (from memory or disk) and misses.'''
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "entries_in_memory": len(self._memory)}
+
+    def _expired(self, stored_at) -> bool:
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def get(self, key) -> tuple:
+        '''
+        Looks up the given key (a tuple of JSON serializable values).
+
+        Returns
+        -------
+        (found, value) : tuple
+            found is False if the key is not cached or expired.
+
+        '''
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if self._db is not None:
+                row = self._db.execute("SELECT stored_at, value FROM metadata WHERE key = ?", (json.dumps(key),)).fetchone()
+                if row is not None and not self._expired(row[0]):
+                    value = json.loads(row[1])
+                    self._remember(key, row[0], value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return True, value
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        '''Stores the value in memory and, if a path was given, on disk.'''
+        stored_at = time.time()
+        with self._lock:
+            self._remember(key, stored_at, value)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)", (json.dumps(key), stored_at, json.dumps(value)))
+                self._db.commit()
+
+    def _remember(self, key, stored_at, value):
+        self._memory[key] = (stored_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def invalidate(self, key=None):
+        '''
+        Removes the given key from memory and disk, or all entries if no key is given
+        (e.g. after datasets were added or changed in ODMF).
+        '''
+        with self._lock:
+            if key is None:
+                self._memory.clear()
+                if self._db is not None:
+                    self._db.execute("DELETE FROM metadata")
+            else:
+                self._memory.pop(key, None)
+                if self._db is not None:
+                    self._db.execute("DELETE FROM metadata WHERE key = ?", (json.dumps(key),))
+            if self._db is not None:
+                self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class CachedDatasetAPI:
+    '''
+    Stand-in for api.dataset that serves dataset listings and dataset objects from a MetadataCache
+    and values from a ValueCache (if given). All other attributes are passed to the wrapped api.dataset.
+    '''
+
+    def __init__(self, dataset_api, cache, value_cache=None):
+        self._dataset_api = dataset_api
+        self.cache = cache
+        self.value_cache = value_cache
+
+    def list(self, **kwargs) -> list:
+        key = ("list", tuple(sorted(kwargs.items())))
+        found, value = self.cache.get(key)
+        if not found:
+            value = list(self._dataset_api.list(**kwargs))
+            self.cache.put(key, value)
+        return value
+
+    def __call__(self, dsid):
+        key = ("dataset", dsid)
+        found, value = self.cache.get(key)
+        if not found:
+            value = self._dataset_api(dsid=dsid)
+            self.cache.put(key, value)
+        return value
+
+    def values_parquet(self, dsid, start=None, end=None):
+        if self.value_cache is None or start is None or end is None:
+            return self._dataset_api.values_parquet(dsid=dsid, start=start, end=end)
+        return self.value_cache.values(self._dataset_api, dsid, start, end)
+
+    def __getattr__(self, name):
+        return getattr(self._dataset_api, name)
+
+
+class CachedAPI:
+    '''
+    Wraps an odmfclient login so that the export functions request metadata through a MetadataCache.
+
+    Parameters
+    ----------
+    api : ?
+        Odmfclient login with url, username and password.
+    cache : MetadataCache, optional
+        The cache to use. The default is None (a new in-memory cache).
+    value_cache : ValueCache, optional
+        Local cache for the values of the datasets. The default is None (values are always downloaded).
+
+    '''
+
+    def __init__(self, api, cache=None, value_cache=None):
+        self._api = api
+        self.cache = cache if cache is not None else MetadataCache()
+        self.value_cache = value_cache
+        self.dataset = CachedDatasetAPI(api.dataset, self.cache, value_cache)
+
+    def __getattr__(self, name):
+        return getattr(self._api, name)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the stages of an export in separate threads connected by bounded queues (used by data_to_ICASA_by_site).
+
+Downloading, transforming and writing then overlap: while one valuetype is aggregated the next one is downloaded,
+and the wall time approaches the time of the slowest stage instead of the sum of all stages. At most queue_size
+items wait between two stages, so memory stays bounded. The last stage (e.g. writing to the workbook) runs in the
+calling thread while it iterates over the result of run_pipeline.
+
+    items = run_pipeline(download(), transform, queue_size=2)
+    for item in items:
+        write(item)
+
+An exception in any stage is raised in the calling thread, and leaving the loop early stops all stages.
+"""
+
+import queue
+import threading
+
+
+class _End:
+    '''Marks the end of the items of a stage, with the exception that ended the stage if it failed.'''
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+def _put(output, item, stop) -> bool:
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _items(source, stop):
+    while not stop.is_set():
+        try:
+            item = source.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if isinstance(item, _End):
+            if item.error is not None:
+                raise item.error
+            return
+        yield item
+
+
+def _run_stage(stage, items, output, stop):
+    results = None
+    try:
+        results = stage(items)
+        for result in results:
+            if not _put(output, result, stop):
+                return
+    except BaseException as error:
+        _put(output, _End(error), stop)
+    else:
+        _put(output, _End(), stop)
+    finally:
+        if results is not None and hasattr(results, "close"):
+            results.close() # e.g. cancels downloads that are still waiting
+
+
+def run_pipeline(source, *stages, queue_size=2):
+    '''
+    Starts a thread that iterates over source and one thread per stage, connected by bounded queues.
+
+    Parameters
+    ----------
+    source : iterable
+        Items produced by the first stage, e.g. a generator downloading data.
+    *stages : functions
+        Generator functions that take an iterator over the items of the previous stage and yield their own items.
+    queue_size : integer, optional
+        Maximum number of items waiting between two stages. The default is 2.
+
+    Returns
+    -------
+    items : generator
+        Items of the last stage, to be consumed in the calling thread.
+
+    '''
+    stop = threading.Event()
+    threads = []
+    items = source
+    for stage in [iter, *stages]:
+        output = queue.Queue(maxsize=queue_size)
+        thread = threading.Thread(target=_run_stage, args=(stage, items, output, stop), daemon=True)
+        thread.start()
+        threads.append(thread)
+        items = _items(output, stop)
+
+    def results():
+        try:
+            yield from items
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    return results()
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight instrumentation of the scripts (export_ODMF.py, data_transform.py, convert_campbell.py and ICASA_glossary.py).
+
+A run is wrapped in a RunReport. The functions of the scripts mark their stages (download, aggregation, merge,
+reading and saving Excel files ...) with stage(), which measures the time and collects rows and bytes going in and out.
+Stages of the same name are summed up. At the end of the run a json report is written, optionally with a cProfile dump.
+
+    with RunReport("export_ODMF", "export_ODMF_report.json") as report:
+        api = CachedAPI(report.count_calls(odmf_api), metadata_cache)    # counts the requests sent to ODMF
+        data_to_ICASA_by_valuetype(api, ...)
+
+Scripts without a function to wrap can call report = RunReport(...).start() at the beginning and report.finish() at the end.
+Outside of a RunReport, stage() does nothing but run the code inside it, so the functions can be used as before.
+Stages running in several threads at the same time (e.g. downloads with max_workers > 1) add up to more than the wall time.
+"""
+
+import cProfile
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
+
+
+_active = None # report of the current run, shared by all threads
+_lock = threading.Lock()
+
+
+def frame_bytes(data) -> int:
+    '''Returns the memory used by the columns of a pd.DataFrame (without the content of python objects such as strings).'''
+    return int(data.memory_usage(index=True, deep=False).sum())
+
+
+def peak_rss_bytes():
+    '''Returns the largest resident memory of the process so far, or None if it cannot be measured on this system.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # bytes on macOS, kilobytes on Linux
+
+
+@contextmanager
+def stage(name, **values):
+    '''
+    Measures the code inside the with block as a stage of the current run.
+    Numbers such as rows_in, rows_out, bytes_in or bytes_out can be given here or set in the yielded dictionary.
+    '''
+    record = dict(values)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        report = _active
+        if report is not None:
+            report.record(name, time.perf_counter() - started, **record)
+
+
+def count(name, n=1):
+    '''Adds n to the counter of the given name in the current run.'''
+    report = _active
+    if report is not None:
+        report.count(name, n)
+
+
+class CallCounter:
+    '''
+    Stand-in for an object (e.g. an odmfclient login) that counts and times the calls of its methods in the given report.
+    Attributes holding objects with methods, such as api.dataset, are wrapped as well.
+    '''
+
+    def __init__(self, target, report, prefix):
+        self._target = target
+        self._report = report
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if callable(attribute) or hasattr(attribute, "__dict__"):
+            return CallCounter(attribute, self._report, f"{self._prefix}.{name}")
+        return attribute
+
+    def __call__(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._target(*args, **kwargs)
+        finally:
+            self._report.record_call(self._prefix, time.perf_counter() - started)
+
+    def __enter__(self):
+        self._target.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._target.__exit__(*exc_info)
+
+
+class RunReport:
+    '''
+    Collects the stages, API calls and counters of a run and writes them as json file.
+
+    Parameters
+    ----------
+    name : string
+        Name of the run (e.g. the script).
+    path : string, optional
+        Path of the json report written at the end of the run. The default is None (no file, use to_dict()).
+    profile : boolean, optional
+        Switch to run cProfile on the calling thread and store the statistics next to the report (<path>.prof). The default is False.
+    trace_memory : boolean, optional
+        Switch to trace the memory allocated by python and numpy (tracemalloc), which slows down the run. The default is False.
+
+    '''
+
+    def __init__(self, name, path=None, profile=False, trace_memory=False):
+        self.name = name
+        self.path = path
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.api_calls = {}
+        self.counters = {}
+        self.info = {} # further json serializable information, e.g. cache statistics
+        self.status = None
+        self._started_at = None
+        self._started = None
+        self._wall_seconds = None
+        self._profiler = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(exc_type, exc)
+        return False
+
+    def start(self):
+        '''Starts the run (for scripts without a with block, call finish() at the end).'''
+        global _active
+        _active = self
+        self._started_at = datetime.datetime.now().isoformat(timespec="seconds")
+        self._started = time.perf_counter()
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def finish(self, exc_type=None, exc=None):
+        '''Ends the run and writes the report to path (if given).'''
+        global _active
+        if self._profiler is not None:
+            self._profiler.disable()
+        self._wall_seconds = time.perf_counter() - self._started
+        self.status = "ok" if exc_type is None else f"failed: {exc_type.__name__}: {exc}"
+        if self.trace_memory:
+            self.info["python_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        _active = None
+        if self.path is not None:
+            self.write(self.path)
+
+    def record(self, name, seconds, **values):
+        '''Adds a measurement to the stage of the given name.'''
+        with _lock:
+            entry = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            for key, value in values.items():
+                if value is not None:
+                    entry[key] = entry.get(key, 0) + value
+            peak = peak_rss_bytes()
+            if peak is not None:
+                entry["peak_rss_bytes"] = peak # memory high-water mark of the process when the stage ended
+            if self.trace_memory and tracemalloc.is_tracing():
+                entry["python_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+
+    def record_call(self, name, seconds):
+        with _lock:
+            entry = self.api_calls.setdefault(name, {"calls": 0, "seconds": 0.0})
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+
+    def count(self, name, n=1):
+        with _lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def count_calls(self, api, prefix="api") -> CallCounter:
+        '''Wraps the api so that the calls of its methods (e.g. api.dataset.values_parquet) are counted in this report.'''
+        return CallCounter(api, self, prefix)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "started": self._started_at,
+            "wall_seconds": self._wall_seconds,
+            "status": self.status,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "stages": self.stages,
+            "api_calls": self.api_calls,
+            "counters": self.counters,
+            "info": self.info,
+        }
+
+    def write(self, path):
+        '''Writes the report as json file and, if profile is True, the cProfile statistics to <path>.prof.'''
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=1, default=str)
+        if self._profiler is not None:
+            self._profiler.dump_stats(os.path.splitext(path)[0] + ".prof")
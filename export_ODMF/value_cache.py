@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache for values downloaded from the ODMF database with api.dataset.values_parquet.
+
+Each downloaded sub-range of a dataset is stored as a Parquet part file in the cache directory. An index (index.json) remembers
+which time intervals of each dataset are already stored and which part file covers which time span, so a request only downloads 
+the parts of the time span that are missing and reads only the part files (and row groups) overlapping the requested span from disk. 
+Overlapping and adjacent intervals are merged. When a dataset has more than max_parts part files, they are combined into one.
+If the cache grows larger than max_bytes, the least recently used datasets are removed.
+
+Use it together with the metadata cache:
+
+    with login(url, username, password) as api:
+        api = CachedAPI(api, value_cache=ValueCache("odmf_values"))
+        data_to_ICASA_by_valuetype(api, ...)
+
+Values that are uploaded to ODMF later for a time span that is already cached are not seen by the cache.
+The last settle_time before each download is therefore not marked as cached, and refresh=True (or invalidate())
+downloads the data again.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+ADJACENT = pd.Timedelta(seconds=1) # intervals closer than this are merged (an export ends at 23:59:59, the next day starts at 00:00:00)
+
+
+def to_timestamp(value) -> pd.Timestamp:
+    '''Converts a date or time stamp (e.g. "2025-10-18" or "2025-10-20T23:59:59Z") to a time stamp without time zone.'''
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert(None)
+    return timestamp
+
+
+def merge_intervals(intervals) -> list:
+    '''Merges overlapping and adjacent (start, end) intervals and returns them sorted.'''
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + ADJACENT:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def missing_intervals(intervals, start, end) -> list:
+    '''Returns the parts of the interval (start, end) that are not covered by the given merged intervals.'''
+    missing = []
+    current = start
+    for covered_start, covered_end in intervals:
+        if covered_end < current:
+            continue
+        if covered_start > end:
+            break
+        if covered_start > current:
+            missing.append((current, covered_start))
+        current = max(current, covered_end)
+    if current < end:
+        missing.append((current, end))
+    return missing
+
+
+class ValueCache:
+    '''
+    Parquet-backed cache of dataset values with interval bookkeeping and LRU eviction.
+
+    Parameters
+    ----------
+    directory : string
+        Folder in which the Parquet files and the index are stored. It is created if it does not exist.
+    max_bytes : integer, optional
+        Maximum size of all Parquet files. The default is None (no limit).
+    settle_time : string or pd.Timedelta, optional
+        Time before each download in which values may still be uploaded to ODMF. This part is downloaded again next time. The default is "1D".
+    refresh : boolean, optional
+        Switch to download all requested values again (and update the cache). The default is False.
+    max_parts : integer, optional
+        Number of part files of a dataset above which they are combined into one file. The default is 32.
+
+    '''
+
+    def __init__(self, directory, max_bytes=None, settle_time="1D", refresh=False, max_parts=32):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.settle_time = pd.Timedelta(settle_time)
+        self.refresh = refresh
+        self.max_parts = max_parts
+        self.downloads = 0
+        self.served_from_cache = 0
+        self._lock = threading.Lock() # guards the index, the Parquet files are read and written under the lock of their dataset
+        self._dataset_locks = {}
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, "index.json")
+        self._index = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                self._index = json.load(f)
+
+    @property
+    def stats(self) -> dict:
+        '''Counters of downloaded sub-ranges and requests served from the cache alone.'''
+        return {"downloads": self.downloads, "served_from_cache": self.served_from_cache, "datasets": len(self._index), "bytes": sum(entry["bytes"] for entry in self._index.values())}
+
+    def _file(self, name) -> str:
+        return os.path.join(self.directory, name)
+
+    def _dataset_lock(self, dataset_id) -> threading.Lock:
+        with self._lock:
+            return self._dataset_locks.setdefault(str(dataset_id), threading.Lock())
+
+    def _intervals(self, dataset_id) -> list:
+        entry = self._index.get(str(dataset_id))
+        if entry is None:
+            return []
+        return [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in entry["intervals"]]
+
+    def _parts(self, dataset_id) -> list:
+        entry = self._index.get(str(dataset_id))
+        if entry is None:
+            return []
+        if "parts" not in entry: # cache written before part files were used: one file with all values
+            single = f"{dataset_id}.parquet"
+            return [{"file": single, "start": None, "end": None, "bytes": entry["bytes"]}] if os.path.exists(self._file(single)) else []
+        return list(entry["parts"])
+
+    def values(self, dataset_api, dsid, start, end) -> pd.DataFrame:
+        '''
+        Returns the values of the dataset between start and end (both included), like dataset_api.values_parquet,
+        downloading only the sub-ranges that are not cached yet.
+        '''
+        start_time = to_timestamp(start)
+        end_time = to_timestamp(end)
+        with self._dataset_lock(dsid):
+            with self._lock:
+                intervals = self._intervals(dsid)
+                parts = self._parts(dsid)
+            missing = missing_intervals([] if self.refresh else intervals, start_time, end_time)
+
+            empty = None
+            for missing_start, missing_end in missing:
+                downloaded_at = pd.Timestamp.now("UTC").tz_localize(None)
+                downloaded = dataset_api.values_parquet(dsid=dsid, start=missing_start.isoformat(), end=missing_end.isoformat())
+                settled_end = min(missing_end, downloaded_at - self.settle_time)
+                if settled_end > missing_start:
+                    intervals.append((missing_start, settled_end))
+                if downloaded.empty:
+                    empty = downloaded
+                    continue
+                name = f"{dsid}-{uuid.uuid4().hex[:12]}.parquet"
+                downloaded.to_parquet(self._file(name), index=False)
+                parts.append({"file": name, "start": missing_start.isoformat(), "end": missing_end.isoformat(), "bytes": os.path.getsize(self._file(name))})
+            if len(parts) > self.max_parts:
+                parts = self._combine(dsid, parts)
+            cached = self._read(parts, start_time, end_time)
+
+            with self._lock:
+                self.downloads += len(missing)
+                self.served_from_cache += not missing
+                if missing:
+                    self._index[str(dsid)] = {
+                        "intervals": [[s.isoformat(), e.isoformat()] for s, e in merge_intervals(intervals)],
+                        "parts": parts,
+                        "bytes": sum(part["bytes"] for part in parts),
+                        "last_used": time.time(),
+                    }
+                    self._evict(keep=str(dsid))
+                elif str(dsid) in self._index:
+                    self._index[str(dsid)]["last_used"] = time.time()
+                self._save_index()
+
+        if cached is None:
+            return empty if empty is not None else pd.DataFrame(columns=["time", "value"])
+        times = cached["time"]
+        if getattr(times.dt, "tz", None) is not None:
+            times = times.dt.tz_convert(None)
+        return cached[(times >= start_time) & (times <= end_time)].reset_index(drop=True)
+
+    def _read_part(self, part, start_time, end_time) -> pd.DataFrame:
+        '''Reads the rows of a part file between start_time and end_time, skipping the row groups outside the span.'''
+        path = self._file(part["file"])
+        time_type = pq.read_schema(path).field("time").type
+        filters = None
+        if pa.types.is_timestamp(time_type):
+            bounds = [pa.scalar(timestamp.as_unit("ns").value, pa.timestamp("ns")).cast(time_type) for timestamp in (start_time, end_time)]
+            filters = (pc.field("time") >= bounds[0]) & (pc.field("time") <= bounds[1])
+        return pq.read_table(path, filters=filters).to_pandas()
+
+    def _read(self, parts, start_time, end_time):
+        '''Reads the values between start_time and end_time from the part files overlapping the span (later parts replace values of earlier ones).'''
+        frames = [self._read_part(part, start_time, end_time) for part in parts
+                  if part["start"] is None or (pd.Timestamp(part["start"]) <= end_time and pd.Timestamp(part["end"]) >= start_time)]
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return None
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True).drop_duplicates(subset="time", keep="last").sort_values("time", ignore_index=True)
+
+    def _combine(self, dataset_id, parts) -> list:
+        '''Combines the part files of a dataset into one file and returns the new list of parts.'''
+        frames = [pd.read_parquet(self._file(part["file"])) for part in parts]
+        combined = pd.concat(frames, ignore_index=True).drop_duplicates(subset="time", keep="last").sort_values("time", ignore_index=True)
+        name = f"{dataset_id}-{uuid.uuid4().hex[:12]}.parquet"
+        combined.to_parquet(self._file(name), index=False)
+        for part in parts:
+            os.remove(self._file(part["file"]))
+        starts = [part["start"] for part in parts]
+        span = (None, None) if None in starts else (min(starts), max(part["end"] for part in parts))
+        return [{"file": name, "start": span[0], "end": span[1], "bytes": os.path.getsize(self._file(name))}]
+
+    def _evict(self, keep):
+        if self.max_bytes is None:
+            return
+        total = sum(entry["bytes"] for entry in self._index.values())
+        for dataset_id, entry in sorted(self._index.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if dataset_id == keep or self._dataset_locks.get(dataset_id, threading.Lock()).locked():
+                continue # datasets that are read or written right now are kept
+            self._remove(dataset_id)
+            total -= entry["bytes"]
+
+    def _remove(self, dataset_id):
+        parts = self._parts(dataset_id)
+        self._index.pop(str(dataset_id), None)
+        for part in parts:
+            if os.path.exists(self._file(part["file"])):
+                os.remove(self._file(part["file"]))
+
+    def _save_index(self):
+        with open(self._index_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f)
+
+    def invalidate(self, dataset_id=None):
+        '''Removes the given dataset, or all datasets if no dataset_id is given, from the cache.'''
+        with self._lock:
+            for cached_id in ([str(dataset_id)] if dataset_id is not None else list(self._index)):
+                self._remove(cached_id)
+            self._save_index()